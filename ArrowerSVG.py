@@ -13,16 +13,22 @@ from __future__ import print_function, division
 from sys import version_info
 if version_info[0]==2:
     range = xrange
+else:
+    from sys import intern
 
 import os
 import sys
-import argparse
-from Bio import SeqIO
-from random import uniform
+import csv
+import shutil
+from random import choice, Random
 from colorsys import hsv_to_rgb
 from colorsys import rgb_to_hsv
-from math import sin, atan2, pi
+from math import hypot
 from collections import defaultdict
+from contextlib import contextmanager
+
+# Bio.SeqIO is slow to import; it is only loaded once a GenBank file has to be read
+_SeqIO = None
 
 global internal_domain_margin
 global gene_contour_thickness
@@ -34,29 +40,43 @@ domain_contour_thickness = 1
 gene_contour_thickness = 2 # thickness grows outwards
 stripe_thickness = 3
 
-domains_color_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), "domains_color_file.tsv")
+# data files live next to this script, not in the current working directory
+_MODULE_DIR = os.path.dirname(os.path.realpath(__file__))
+gene_color_file = os.path.join(_MODULE_DIR, "gene_color_file.tsv")
+domains_color_file = os.path.join(_MODULE_DIR, "domains_color_file.tsv")
+pfam_domain_categories_file = os.path.join(_MODULE_DIR, "pfam_domain_categories.tsv")
+
+# darker versions of colors already seen, keyed by (color, factor)
+_contour_cache = {}
 
 
 # read various color data
+def _read_color_file(color_file):
+    """Reads a file with a name and a "r,g,b" color per line (tab separated)"""
+    colors = {}
+    with open(color_file, "r") as color_handle:
+        for row in csv.reader(color_handle.read().splitlines(), delimiter="\t", quoting=csv.QUOTE_NONE):
+            # skip comments and empty lines
+            if not row or not row[0].strip() or row[0][0] == "#":
+                continue
+            rgb = row[1].split(",")
+            colors[intern(row[0])] = tuple(int(c) for c in rgb)
+    
+    return colors
+
+
 def read_color_genes_file():
     # Try to read already-generated colors for genes
     color_genes = {}
     
     if os.path.isfile(gene_color_file):
         print("  Found file with gene colors")
-        with open(gene_color_file, "r") as color_genes_handle:
-            for line in color_genes_handle:
-                # handle comments and empty lines
-                if line[0] != "#" and line.strip():
-                    row = line.strip().split("\t")
-                    name = row[0]
-                    rgb = row[1].split(",")
-                    color_genes[name] = [int(rgb[x]) for x in range(3)]
+        color_genes = _read_color_file(gene_color_file)
     else:
         print("  Gene color file was not found. A new file will be created")
         with open(gene_color_file, "w") as color_genes_handle:
             color_genes_handle.write("NoName\t255,255,255\n")
-        color_genes = {"NoName":[255, 255, 255]}
+        color_genes = {"NoName":(255, 255, 255)}
     
     return color_genes
 
@@ -67,17 +87,10 @@ def read_color_domains_file():
     
     if os.path.isfile(domains_color_file):
         print("  Found file with domains colors")
-        with open(domains_color_file, "r") as color_domains_handle:
-            for line in color_domains_handle:
-                # handle comments and empty lines
-                if line[0] != "#" and line.strip():
-                    row = line.strip().split("\t")
-                    name = row[0]
-                    rgb = row[1].split(",")
-                    color_domains[name] = [int(rgb[x]) for x in range(3)]
+        color_domains = _read_color_file(domains_color_file)
     else:
         print("  Domains colors file was not found. An empty file will be created")
-        color_domains_handle = open(domains_color_file, "a+")
+        open(domains_color_file, "a").close()
         
     return color_domains
 
@@ -86,9 +99,9 @@ def read_color_domains_file():
 def read_pfam_domain_categories():
     pfam_category = {}
     
-    if os.path.isfile(pfam_domain_categories):
+    if os.path.isfile(pfam_domain_categories_file):
         print("  Found file with Pfam domain categories")
-        with open(pfam_domain_categories, "r") as cat_handle:            
+        with open(pfam_domain_categories_file, "r") as cat_handle:            
             for line in cat_handle:
                 # handle comments and empty lines
                 if line[0] != "#" and line.strip():
@@ -121,19 +134,19 @@ def draw_arrow(additional_tabs, X, Y, L, l, H, h, strand, color, color_contour,
         head_end = L
         if L < l:
             # squeeze arrow if length shorter than head length
-            A = [X,Y-h]
-            B = [X+L,Y+H/2]
-            C = [X,Y+H+h]
+            A = (X,Y-h)
+            B = (X+L,Y+H/2)
+            C = (X,Y+H+h)
             head_start = 0
             points = [A, B, C]
         else:
-            A = [X,Y]
-            B = [X+L-l,Y]
-            C = [X+L-l,Y-h]
-            D = [X+L,Y+H/2]
-            E = [X+L-l,Y+H+h]
-            F = [X+L-l,Y+H]
-            G = [X,Y+H]
+            A = (X,Y)
+            B = (X+L-l,Y)
+            C = (X+L-l,Y-h)
+            D = (X+L,Y+H/2)
+            E = (X+L-l,Y+H+h)
+            F = (X+L-l,Y+H)
+            G = (X,Y+H)
             head_start = L - l # relative to the start of the gene, not absolute coords.
             points = [A, B, C, D, E, F, G]
 
@@ -141,19 +154,19 @@ def draw_arrow(additional_tabs, X, Y, L, l, H, h, strand, color, color_contour,
         head_start = 0
         if L < l:
             # squeeze arrow if length shorter than head length
-            A = [X,Y+H/2]
-            B = [X+L,Y-h]
-            C = [X+L,Y+H+h]
+            A = (X,Y+H/2)
+            B = (X+L,Y-h)
+            C = (X+L,Y+H+h)
             head_end = L
             points = [A, B, C]
         else:
-            A = [X+L,Y]
-            B = [X+l,Y]
-            C = [X+l,Y-h]
-            D = [X,Y+H/2]
-            E = [X+l,Y+H+h]
-            F = [X+l,Y+H]
-            G = [X+L,Y+H]
+            A = (X+L,Y)
+            B = (X+l,Y)
+            C = (X+l,Y-h)
+            D = (X,Y+H/2)
+            E = (X+l,Y+H+h)
+            F = (X+l,Y+H)
+            G = (X+L,Y+H)
             head_end = l
             points = [A, B, C, D, E, F, G]
 
@@ -164,172 +177,158 @@ def draw_arrow(additional_tabs, X, Y, L, l, H, h, strand, color, color_contour,
     if head_length == 0:
         return ""
     
-    points_coords = []
-    for point in points:
-        points_coords.append(str(int(point[0])) + "," + str(int(point[1])))
+    points_coords = " ".join(["{},{}".format(int(x), int(y)) for x, y in points])
     
-    arrow = additional_tabs + "\t<g>\n"
+    # collect all fragments and join them at the end. Repeated string
+    # concatenation copies the whole buffer every time
+    parts = [additional_tabs, "\t<g>\n"]
     
     # unidentified genes don't have a title and have a darker contour
     if gid != "NoName":
-        arrow += additional_tabs + "\t\t<title>" + gid + "</title>\n"
+        parts.extend([additional_tabs, "\t\t<title>", gid, "</title>\n"])
     else:
         color_contour = [50, 50, 50]
+    
+    # rgb strings are the same for the whole gene, build them only once
+    rgb_color = "{},{},{}".format(color[0], color[1], color[2])
+    rgb_contour = "{},{},{}".format(color_contour[0], color_contour[1], color_contour[2])
+        
+    parts.append("{}\t\t<polygon class=\"{}\" points=\"{}\" fill=\"rgb({})\" fill-opacity=\"1.0\" stroke=\"rgb({})\" stroke-width=\"{}\" {} />\n".format(
+        additional_tabs, gid, points_coords, rgb_color, rgb_contour, gene_contour_thickness, category))
+    
+    # everything but the domain's own values is the same for all domains
+    rect_y = Y + internal_domain_margin
+    bottom_y = Y + H - internal_domain_margin
+    domain_tail = " stroke-width=\"{}\" opacity=\"0.75\" />\n".format(domain_contour_thickness)
+    rect_fmt = additional_tabs + "\t\t\t<rect class=\"{}\" x=\"{}\" y=\"{}\" stroke-linejoin=\"round\" width=\"{}\" height=\"{}\" fill=\"rgb({})\" stroke=\"rgb({})\"" + domain_tail
+    poly_fmt = additional_tabs + "\t\t\t<polygon class=\"{}\" points=\"{}\" stroke-linejoin=\"round\" width=\"{}\" height=\"{}\" fill=\"rgb({})\" stroke=\"rgb({})\"" + domain_tail
+    title_fmt = additional_tabs + "\t\t<g>\n" + additional_tabs + "\t\t\t<title>{} ({})\n\"{}\"</title>\n"
+    domain_close = additional_tabs + "\t\t</g>\n"
+    
+    # calculate how far from head_start we (the horizontal guide at y=Y+internal_domain_margin)
+    #  would crash with the slope. This only depends on the gene's arrow
+    # Using similar triangles:
+    if strand == "+":
+        collision_x = head_length * (h + internal_domain_margin)
+        collision_x /= (h + H/2.0)
+        collision_x = round(collision_x)
         
-    arrow += "{}\t\t<polygon class=\"{}\" ".format(additional_tabs, gid)
-    arrow += "points=\"{}\" fill=\"rgb({})\" ".format(" ".join(points_coords), ",".join([str(val) for val in color]))
-    arrow += "fill-opacity=\"1.0\" stroke=\"rgb({})\" ".format(",".join([str(val) for val in color_contour]))
-    arrow += "stroke-width=\"{}\" {} />\n".format(str(gene_contour_thickness), category)
+        # either option for x_margin_offset work
+        #m = -float(h + H/2)/(head_length) #slope of right line
+        #x_margin_offset = (internal_domain_margin*sqrt(1+m*m))/m
+        #x_margin_offset = -(x_margin_offset)
+        # internal_domain_margin/sin(pi - atan2(h+H/2.0,-head_length)), without the trigonometry
+        x_margin_offset = internal_domain_margin*hypot(head_length, h+H/2.0)/(h+H/2.0)
+        
+        # domains ending before this are plain rectangles
+        collision_limit = head_start + collision_x - x_margin_offset
+    else:
+        collision_x = head_length * ((H/2) - internal_domain_margin)
+        collision_x /= (h + H/2.0)
+        collision_x = round(collision_x)
+        
+        # internal_domain_margin/sin(atan2(h+H/2.0,head_length))
+        x_margin_offset = round(internal_domain_margin*hypot(head_length, h+H/2.0)/(h+H/2.0))
+        
+        # domains starting after this are plain rectangles
+        collision_limit = collision_x + x_margin_offset
     
     # paint domains. Domains on the tip of the arrow should not have corners sticking
     #  out of them
     for domain in domain_list:
-        #[X, L, H, domain_accession, (domain_name, domain_description), color, color_contour]
-        dX = domain[0]
-        dL = domain[1]
-        dH = domain[2]
-        dacc = domain[3]
-        dname = domain[4][0]
-        ddesc = domain[4][1]
-        dcolor = domain[5]
-        dccolour = domain[6]
+        #(X, L, H, domain_accession, (domain_name, domain_description), rgb color, rgb contour)
+        dX, dL, dH, dacc, (dname, ddesc), dcolor_s, dccol_s = domain
         
-        arrow += additional_tabs + "\t\t<g>\n"
-        arrow += "{}\t\t\t<title>{} ({})\n\"{}\"</title>\n".format(additional_tabs, dname, dacc, ddesc)
+        parts.append(title_fmt.format(dname, dacc, ddesc))
         
         if strand == "+":
-            # calculate how far from head_start we (the horizontal guide at y=Y+internal_domain_margin)
-            #  would crash with the slope
-            # Using similar triangles:
-            collision_x = head_length * (h + internal_domain_margin)
-            collision_x /= (h + H/2.0)
-            collision_x = round(collision_x)
-            
-            # either option for x_margin_offset work
-            #m = -float(h + H/2)/(head_length) #slope of right line
-            #x_margin_offset = (internal_domain_margin*sqrt(1+m*m))/m
-            #x_margin_offset = -(x_margin_offset)
-            x_margin_offset = internal_domain_margin/sin(pi - atan2(h+H/2.0,-head_length))
-
-            if (dX + dL) < head_start + collision_x - x_margin_offset:
-                arrow += "{}\t\t\t<rect class=\"{}\" x=\"{}\" ".format(additional_tabs, dacc, str(X+dX))
-                arrow += "y=\"{}\" stroke-linejoin=\"round\" ".format(str(Y + internal_domain_margin))
-                arrow += "width=\"{}\" height=\"{}\" ".format(str(dL), str(dH))
-                arrow += "fill=\"rgb({})\" stroke=\"rgb({})\" ".format(",".join([str(val) for val in dcolor]), ",".join([str(val) for val in dccolour]))
-                arrow += "stroke-width=\"{}\" opacity=\"0.75\" />\n".format(str(domain_contour_thickness))
+            if (dX + dL) < collision_limit:
+                parts.append(rect_fmt.format(dacc, X+dX, rect_y, dL, dH, dcolor_s, dccol_s))
             else:
-                del points[:]
+                points = []
                 
-                if dX < head_start + collision_x - x_margin_offset:
+                if dX < collision_limit:
                     # add points A and B
-                    points.append([X + dX, Y + internal_domain_margin])
-                    points.append([X + head_start + collision_x - x_margin_offset, Y + internal_domain_margin])
+                    points.append((X + dX, rect_y))
+                    points.append((X + collision_limit, rect_y))
                     
                 else:
                     # add point A'
                     start_y_offset = (h + H/2)*(L - x_margin_offset - dX)
                     start_y_offset /= head_length
                     start_y_offset = int(start_y_offset)
-                    points.append([X + dX, int(Y + H/2 - start_y_offset)])
+                    points.append((X + dX, int(Y + H/2 - start_y_offset)))
                     
                     
                 # handle the rightmost part of the domain
                 if dX + dL >= head_end - x_margin_offset: # could happen more easily with the scaling
-                    points.append([X + head_end - x_margin_offset, int(Y + H/2)]) # right part is a triangle
+                    points.append((X + head_end - x_margin_offset, int(Y + H/2))) # right part is a triangle
                 else:
                     # add points C and D
                     end_y_offset = (2*h + H)*(L - x_margin_offset - dX - dL)
                     end_y_offset /= 2*head_length
                     end_y_offset = int(end_y_offset)
 
-                    points.append([X + dX + dL, int(Y + H/2 - end_y_offset)])
-                    points.append([X + dX + dL, int(Y + H/2 + end_y_offset)])
+                    points.append((X + dX + dL, int(Y + H/2 - end_y_offset)))
+                    points.append((X + dX + dL, int(Y + H/2 + end_y_offset)))
             
                 # handle lower part
-                if dX < head_start + collision_x - x_margin_offset:
+                if dX < collision_limit:
                     # add points E and F
-                    points.append([X + head_start + collision_x - x_margin_offset, Y + H - internal_domain_margin])
-                    points.append([X + dX, Y + H - internal_domain_margin])                    
+                    points.append((X + collision_limit, bottom_y))
+                    points.append((X + dX, bottom_y))                    
                 else:
                     # add point F'
-                    points.append([X + dX, int(Y + H/2 + start_y_offset)])
+                    points.append((X + dX, int(Y + H/2 + start_y_offset)))
             
                        
-                del points_coords[:]
-                for point in points:
-                    points_coords.append(str(int(point[0])) + "," + str(int(point[1])))
+                points_coords = " ".join(["{},{}".format(int(x), int(y)) for x, y in points])
                     
-                arrow += "{}\t\t\t<polygon class=\"{}\" ".format(additional_tabs, dacc)
-                arrow += "points=\"{}\" stroke-linejoin=\"round\" ".format(" ".join(points_coords))
-                arrow += "width=\"{}\" height=\"{}\" ".format(str(dL), str(dH))
-                arrow += "fill=\"rgb({})\" ".format(",".join([str(val) for val in dcolor]))
-                arrow += "stroke=\"rgb({})\" ".format(",".join([str(val) for val in dccolour]))
-                arrow += "stroke-width=\"{}\" opacity=\"0.75\" />\n".format(str(domain_contour_thickness))
+                parts.append(poly_fmt.format(dacc, points_coords, dL, dH, dcolor_s, dccol_s))
             
         # now check other direction
         else:
-            # calculate how far from head_start we (the horizontal guide at y=Y+internal_domain_margin)
-            #  would crash with the slope
-            # Using similar triangles:
-            collision_x = head_length * ((H/2) - internal_domain_margin)
-            collision_x /= (h + H/2.0)
-            collision_x = round(collision_x)
-            
-            x_margin_offset = round(internal_domain_margin/sin(atan2(h+H/2.0,head_length)))
-            
             # nice, blocky domains
-            if dX > collision_x + x_margin_offset:
-                arrow += "{}\t\t\t<rect class=\"{}\" ".format(additional_tabs, dacc)
-                arrow += "x=\"{}\" y=\"{}\" ".format(str(X+dX), str(Y + internal_domain_margin))
-                arrow += "stroke-linejoin=\"round\" width=\"{}\" height=\"{}\" ".format(str(dL), str(dH))
-                arrow += "fill=\"rgb({})\" ".format(",".join([str(val) for val in dcolor]))
-                arrow += "stroke=\"rgb({})\" ".format(",".join([str(val) for val in dccolour]))
-                arrow += "stroke-width=\"{}\" opacity=\"0.75\" />\n".format(str(domain_contour_thickness))
+            if dX > collision_limit:
+                parts.append(rect_fmt.format(dacc, X+dX, rect_y, dL, dH, dcolor_s, dccol_s))
             else:
-                del points[:]
+                points = []
                 
                 # handle lefthand side. Regular point or pointy start?
                 if dX >= x_margin_offset:
                     start_y_offset = round((h + H/2)*(dX - x_margin_offset)/head_length)
-                    points.append([X + dX, Y + H/2 - start_y_offset])
+                    points.append((X + dX, Y + H/2 - start_y_offset))
                 else:
-                    points.append([X + x_margin_offset, Y + H/2])
+                    points.append((X + x_margin_offset, Y + H/2))
                     
                     
                 # handle middle/end
-                if dX + dL < collision_x + x_margin_offset:
+                if dX + dL < collision_limit:
                     if head_length != 0:
                         end_y_offset = round((h + H/2)*(dX + dL - x_margin_offset)/head_length)
                     else:
                         end_y_offset = 0
-                    points.append([X + dX + dL, Y + H/2 - end_y_offset])
-                    points.append([X + dX + dL, Y + H/2 + end_y_offset])
+                    points.append((X + dX + dL, Y + H/2 - end_y_offset))
+                    points.append((X + dX + dL, Y + H/2 + end_y_offset))
                 else:
-                    points.append([X + collision_x + x_margin_offset, Y + internal_domain_margin])
-                    points.append([X + dX + dL, Y + internal_domain_margin])
-                    points.append([X + dX + dL, Y + internal_domain_margin + dH])
-                    points.append([X + collision_x + x_margin_offset, Y + internal_domain_margin + dH])
+                    points.append((X + collision_limit, rect_y))
+                    points.append((X + dX + dL, rect_y))
+                    points.append((X + dX + dL, rect_y + dH))
+                    points.append((X + collision_limit, rect_y + dH))
                     
                 # last point, if it's not a pointy domain
                 if dX >= x_margin_offset:
-                    points.append([X + dX, Y + H/2 + start_y_offset])
+                    points.append((X + dX, Y + H/2 + start_y_offset))
                        
-                del points_coords[:]
-                for point in points:
-                    points_coords.append(str(int(point[0])) + "," + str(int(point[1])))
+                points_coords = " ".join(["{},{}".format(int(x), int(y)) for x, y in points])
                     
-                arrow += "{}\t\t\t<polygon class=\"{}\" ".format(additional_tabs, dacc)
-                arrow += "points=\"{}\" stroke-linejoin=\"round\" ".format(" ".join(points_coords))
-                arrow += "width=\"{}\" height=\"{}\" ".format(str(dL), str(dH))
-                arrow += "fill=\"rgb({})\" ".format(",".join([str(val) for val in dcolor]))
-                arrow += "stroke=\"rgb({})\" ".format(",".join([str(val) for val in dccolour]))
-                arrow += "stroke-width=\"{}\" opacity=\"0.75\" />\n".format(str(domain_contour_thickness))
+                parts.append(poly_fmt.format(dacc, points_coords, dL, dH, dcolor_s, dccol_s))
         
-        arrow += additional_tabs + "\t\t</g>\n"
+        parts.append(domain_close)
     
-    arrow += additional_tabs + "\t</g>\n"
+    parts.extend([additional_tabs, "\t</g>\n"])
 
-    return arrow
+    return "".join(parts)
 
 
 def draw_line(X,Y,L):
@@ -342,24 +341,97 @@ def draw_line(X,Y,L):
     return line
 
 
-def new_color(gene_or_domain):
+def _darken(color, factor):
+    """Return color with its value (hsv) scaled by factor. Results are cached
+    as the same gene/domain colors are used over and over"""
+    key = (tuple(color), factor)
+    try:
+        return _contour_cache[key]
+    except KeyError:
+        h_, s, v = rgb_to_hsv(float(color[0])/255.0, float(color[1])/255.0, float(color[2])/255.0)
+        contour = tuple(int(c * 255) for c in hsv_to_rgb(h_, s, factor*v))
+        _contour_cache[key] = contour
+        return contour
+
+
+def _make_palette(s_range, v_range, size=1024):
+    """
+    Colors evenly spread over all hues, with saturation and value taken at 
+    random (but always the same) within the given ranges
+    """
     # see https://en.wikipedia.org/wiki/HSL_and_HSV
     # and http://stackoverflow.com/a/1586291
+    rng = Random(size)
+    palette = []
+    for i in range(size):
+        s = rng.uniform(s_range[0], s_range[1])
+        v = rng.uniform(v_range[0], v_range[1])
+        palette.append(tuple(int(c * 255) for c in hsv_to_rgb(i/size, s, v)))
     
-    h = uniform(0, 1) # all possible colors
+    return palette
+
+
+_gene_palette = _make_palette((0.15, 0.3), (0.98, 1.0))
+_domain_palette = _make_palette((0.5, 0.75), (0.7, 0.9)) # lower s: less saturated, lower v: darker
+
 
+def new_color(gene_or_domain):
     if gene_or_domain == "gene":
-        s = uniform(0.15, 0.3)
-        v = uniform(0.98, 1.0)
+        return choice(_gene_palette)
     elif gene_or_domain == "domain":
-        s = uniform(0.5, 0.75) # lower: less saturated
-        v = uniform(0.7, 0.9) # lower = darker
+        return choice(_domain_palette)
     else:
         sys.exit("unknown kind of color. Should be 'gene' or 'domain'")
-        
-    r, g, b = tuple(int(c * 255) for c in hsv_to_rgb(h, s, v))
+
+
+def add_new_domain_colors(pfdFiles, color_domains):
+    """
+    Assign a color to every domain in the pfd files that is not yet in 
+    color_domains and append the new colors to the domains color file.
+    Doing this beforehand means that SVG() will not need to update the file
+    and can be run in parallel
+    """
+    new_color_domains = {}
+    for pfdFile in pfdFiles:
+        with open(pfdFile, "r") as pfd_handle:
+            for line in pfd_handle:
+                domain_acc = line.split("\t")[5].split(".")[0]
+                if domain_acc not in color_domains:
+                    color = new_color("domain")
+                    new_color_domains[domain_acc] = color
+                    color_domains[domain_acc] = color
+    
+    if len(new_color_domains) > 0:
+        with open(domains_color_file, "a") as color_domains_handle:
+            color_domains_handle.writelines(["{}\t{},{},{}\n".format(name, c[0], c[1], c[2]) for name, c in new_color_domains.items()])
+
+
+@contextmanager
+def _figure_file(outputfile, append):
+    """
+    Figures are streamed into a temporary file which only replaces (or is 
+    appended to) outputfile once it has been completely written. That way, if 
+    drawing fails halfway, no truncated figure is left behind
+    """
+    tmp_file = outputfile + ".tmp"
+    handle = open(tmp_file, "w", 1048576)
+    try:
+        yield handle
+        handle.close()
+    except:
+        handle.close()
+        os.remove(tmp_file)
+        raise
     
-    return [r, g, b]
+    if append:
+        with open(outputfile, "a") as out_handle, open(tmp_file, "r") as tmp_handle:
+            shutil.copyfileobj(tmp_handle, out_handle)
+        os.remove(tmp_file)
+    else:
+        # os.rename does not overwrite existing files on Windows
+        if os.path.isfile(outputfile):
+            os.remove(outputfile)
+        os.rename(tmp_file, outputfile)
 
 
 def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_genes, color_domains, pfam_domain_categories, pfam_info, loci, max_width, H=30, h=15, l=30, mX=10, mY=10, scaling=30, absolute_start=0, absolute_end=-1):
@@ -371,31 +443,35 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
         - write the SVG files
     '''
     
-    # for colors not found in colors_genes and color_domains, we need to generate them from scratch
+    # colors not found in color_genes and color_domains are generated here. 
+    # bigscape assigns all domain colors beforehand (add_new_domain_colors), 
+    # so new colors only come up when SVG() is used on its own
     new_color_genes = {}
     new_color_domains = {}
     
-    SVG_TEXT = "" # here we keep all the text that will be written down as a file
-    
     # check whether we have a corresponding pfd file wih domain annotations
     if use_pfd:
         if not os.path.isfile(pfdFile):
             sys.exit("Error (Arrower): " + pfdFile + " not found")
    
 
-    # --- create SVG header. We have to get max_width first
-    # This means that we have to read the gbk file once to know num loci, max_width
+    # --- read GenBank file. Records are kept for drawing later
+    global _SeqIO
+    if _SeqIO is None:
+        from Bio import SeqIO as _SeqIO
+    try:
+        records = list(_SeqIO.parse(GenBankFile, "genbank"))
+    except:
+        sys.exit(" Arrower: error while opening GenBank")
+    
+    # --- create SVG header. Unless given by the caller, the number of loci
+    # and max_width are taken from the records read above
     if loci == -1:
-        try:
-            records = list(SeqIO.parse(GenBankFile), "genbank")
-        except:
-            sys.exit(" Arrower: error while opening GenBank")
-        else:
-            loci = len(records)
-            max_width = 0
-            for record in records:
-                if len(record) > max_width:
-                    max_width = len(record)
+        loci = len(records)
+        max_width = 0
+        for record in records:
+            if len(record) > max_width:
+                max_width = len(record)
     
         
     if absolute_end < 0: # absolute_end == -1 means "the whole region"
@@ -421,123 +497,140 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
         
         additional_tabs = "\t"
               
-    SVG_TEXT = header
+    # write straight to the file instead of keeping the whole document in
+    # memory. A big buffer keeps the number of actual writes low
+    with _figure_file(outputfile, write_html == True) as handle:
+        handle.write(header)
               
-    # For info on the color matrix definition: 
-    #  https://www.w3.org/TR/SVG11/filters.html#feColorMatrixElement
-    # Core Bio: "#DC143C", (220, 20, 60) Dark red
-    # Other Bio: 
-    #  original: "#DF809D", (223, 128, 157) Pink .87, 0.5, 0.61
-    #  alternative: #f4a236, (244,162,54) 0.95, 0.63, 0.21
-    # Transporter: "#3F9FBA" (63, 159, 186) Blue
-    #  32839a, (50, 131, 154), 0.19, 0.51, 0.6
-    # Regulator: "#63BB6D" (99, 187, 109) Green
-    #  #127E1B, (18,126,27) 0.07, 0.49, 0.1
-    if len(pfam_domain_categories) > 0:
-        filters = additional_tabs + "<filter id=\"shadow_CoreBio\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
-        filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.85 0 0 0 0 0.08 0 0 0 0 0.23 0 0 0 1 0\" />\n"
-        filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
-        filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
-        filters += additional_tabs + "</filter>\n"
+        # For info on the color matrix definition: 
+        #  https://www.w3.org/TR/SVG11/filters.html#feColorMatrixElement
+        # Core Bio: "#DC143C", (220, 20, 60) Dark red
+        # Other Bio: 
+        #  original: "#DF809D", (223, 128, 157) Pink .87, 0.5, 0.61
+        #  alternative: #f4a236, (244,162,54) 0.95, 0.63, 0.21
+        # Transporter: "#3F9FBA" (63, 159, 186) Blue
+        #  32839a, (50, 131, 154), 0.19, 0.51, 0.6
+        # Regulator: "#63BB6D" (99, 187, 109) Green
+        #  #127E1B, (18,126,27) 0.07, 0.49, 0.1
+        if len(pfam_domain_categories) > 0:
+            filters = additional_tabs + "<filter id=\"shadow_CoreBio\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
+            filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.85 0 0 0 0 0.08 0 0 0 0 0.23 0 0 0 1 0\" />\n"
+            filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
+            filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
+            filters += additional_tabs + "</filter>\n"
         
-        filters += additional_tabs + "<filter id=\"shadow_OtherBio\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
-        filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.95 0 0 0 0 0.63 0 0 0 0 0.21 0 0 0 1 0\" />\n"
-        filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
-        filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
-        filters += additional_tabs + "</filter>\n"
+            filters += additional_tabs + "<filter id=\"shadow_OtherBio\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
+            filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.95 0 0 0 0 0.63 0 0 0 0 0.21 0 0 0 1 0\" />\n"
+            filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
+            filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
+            filters += additional_tabs + "</filter>\n"
         
-        filters += additional_tabs + "<filter id=\"shadow_Transporter\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
-        filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.19 0 0 0 0 0.51 0 0 0 0 0.6 0 0 0 1 0\" />\n"
-        filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
-        filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
-        filters += additional_tabs + "</filter>\n"
+            filters += additional_tabs + "<filter id=\"shadow_Transporter\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
+            filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.19 0 0 0 0 0.51 0 0 0 0 0.6 0 0 0 1 0\" />\n"
+            filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
+            filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
+            filters += additional_tabs + "</filter>\n"
         
-        filters += additional_tabs + "<filter id=\"shadow_Regulator\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
-        filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.07 0 0 0 0 0.49 0 0 0 0 0.1 0 0 0 1 0\" />\n"
-        filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
-        filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
-        filters += additional_tabs + "</filter>\n"
+            filters += additional_tabs + "<filter id=\"shadow_Regulator\" color-interpolation-filters=\"sRGB\" x=\"-65%\" y=\"-25%\" width=\"230%\" height=\"150%\">\n"
+            filters += additional_tabs + "\t<feColorMatrix in=\"SourceGraphic\" result=\"matrixOut\" type=\"matrix\" values=\"0 0 0 0 0.07 0 0 0 0 0.49 0 0 0 0 0.1 0 0 0 1 0\" />\n"
+            filters += additional_tabs + "\t<feGaussianBlur in=\"matrixOut\" result=\"blurOut\" stdDeviation=\"7\" />\n"
+            filters += additional_tabs + "\t<feBlend in=\"SourceGraphic\" in2=\"blurOut\" mode=\"normal\" />\n"
+            filters += additional_tabs + "</filter>\n"
         
-        SVG_TEXT += filters
+            handle.write(filters)
 
-    # --- read in GenBank file
+        # --- read in GenBank file
 
-    # handle domains
-    if use_pfd:
-        identifiers = defaultdict(list)
-        with open(pfdFile, "r") as pfd_handle:
-            for line in pfd_handle:
-                row = line.strip().split("\t")
+        # handle domains
+        if use_pfd:
+            identifiers = defaultdict(list)
+            domain_rgb = {}
+            domain_height = int(H - 2*internal_domain_margin)
+            with open(pfdFile, "r") as pfd_handle:
+                for line in pfd_handle:
+                    row = line.strip().split("\t")
                 
-                # use to access to parent's properties
-                identifier = row[9].replace("<","").replace(">","")
-                # if it's the new version of pfd file, we can take the last part 
-                #  to make it equal to the identifiers used in gene_list. Strand
-                #  is recorded in parent gene anyway
-                if ":strand:+" in identifier:
-                    identifier = identifier.replace(":strand:+", "")
-                    strand = "+"
-                if ":strand:-" in identifier:
-                    identifier = identifier.replace(":strand:-", "")
-                    strand = "-"
+                    # use to access to parent's properties
+                    identifier = row[9].replace("<","").replace(">","")
+                    # if it's the new version of pfd file, we can take the last part 
+                    #  to make it equal to the identifiers used in gene_list. Strand
+                    #  is recorded in parent gene anyway
+                    if ":strand:+" in identifier:
+                        identifier = identifier.replace(":strand:+", "")
+                        strand = "+"
+                    if ":strand:-" in identifier:
+                        identifier = identifier.replace(":strand:-", "")
+                        strand = "-"
                 
 
-                width = 3*(int(row[4]) - int(row[3]))
+                    width = 3*(int(row[4]) - int(row[3]))
                             
-                if strand == "+":
-                    # multiply by 3 because the env. coordinate is in aminoacids, not in bp
-                    # This start is relative to the start of the gene
-                    start = 3*int(row[3])
-                else:
-                    loci_start = int(row[7].replace("<","").replace(">",""))
-                    loci_end = int(row[8].replace("<","").replace(">",""))
+                    if strand == "+":
+                        # multiply by 3 because the env. coordinate is in aminoacids, not in bp
+                        # This start is relative to the start of the gene
+                        start = 3*int(row[3])
+                    else:
+                        loci_start = int(row[7].replace("<","").replace(">",""))
+                        loci_end = int(row[8].replace("<","").replace(">",""))
                                     
-                    start = loci_end - loci_start - 3*int(row[3]) - width
+                        start = loci_end - loci_start - 3*int(row[3]) - width
                 
-                # geometry
-                start = int(start/scaling)
-                width = int(width/scaling)
+                    # geometry
+                    start = int(start/scaling)
+                    width = int(width/scaling)
 
-                # accession
-                domain_acc = row[5].split(".")[0]
+                    # accession
+                    domain_acc = intern(row[5].split(".")[0])
                 
-                # colors
-                try:
-                    color = color_domains[domain_acc]
-                except KeyError:
-                    color = new_color("domain")
-                    new_color_domains[domain_acc] = color
-                    color_domains[domain_acc] = color
-                    pass
-                # contour color is a bit darker. We go to h,s,v space for that
-                h_, s, v = rgb_to_hsv(float(color[0])/255.0, float(color[1])/255.0, float(color[2])/255.0)
-                color_contour = tuple(int(c * 255) for c in hsv_to_rgb(h_, s, 0.8*v))
-
-
-                # [X, L, H, domain_acc, color, color_contour]
-                identifiers[identifier].append([start, width, int(H - 2*internal_domain_margin), domain_acc, pfam_info[domain_acc], color, color_contour])
+                    # colors. The same domain shows up many times, so we keep
+                    #  the rgb strings of its fill and contour ready to use
+                    try:
+                        color_s, contour_s = domain_rgb[domain_acc]
+                    except KeyError:
+                        try:
+                            color = color_domains[domain_acc]
+                        except KeyError:
+                            color = new_color("domain")
+                            new_color_domains[domain_acc] = color
+                            color_domains[domain_acc] = color
+                            pass
+                        # contour color is a bit darker
+                        color_contour = _darken(color, 0.8)
+                        color_s = "{},{},{}".format(color[0], color[1], color[2])
+                        contour_s = "{},{},{}".format(color_contour[0], color_contour[1], color_contour[2])
+                        domain_rgb[domain_acc] = (color_s, contour_s)
+
+
+                    # (X, L, H, domain_acc, (name, description), rgb color, rgb contour)
+                    identifiers[identifier].append((start, width, domain_height, domain_acc, pfam_info[domain_acc], color_s, contour_s))
     
-    loci = 0
-    feature_counter = 1
-    records = list(SeqIO.parse(GenBankFile, "genbank"))
-    for seq_record in records:
-        add_origin_Y = loci * (2*(h+mY) + H)
-
-        # draw a line that coresponds to cluster size
-        ClusterSize = len(seq_record.seq)
-        if (absolute_end - absolute_start) < ClusterSize:
-            ClusterSize = (absolute_end - absolute_start)
+        loci = 0
+        feature_counter = 1
+        abs_s = absolute_start
+        abs_e = absolute_end
+        for seq_record in records:
+            add_origin_Y = loci * (2*(h+mY) + H)
+
+            # draw a line that coresponds to cluster size
+            ClusterSize = len(seq_record.seq)
+            if (absolute_end - absolute_start) < ClusterSize:
+                ClusterSize = (absolute_end - absolute_start)
         
-        line = draw_line(mX, add_origin_Y + mY + h + H/2, ClusterSize/scaling)
+            line = draw_line(mX, add_origin_Y + mY + h + H/2, ClusterSize/scaling)
         
-        SVG_TEXT += additional_tabs + "<g>\n"
+            handle.write(additional_tabs + "<g>\n")
         
-        SVG_TEXT += additional_tabs + "\t" + line
+            handle.write(additional_tabs + "\t" + line)
         
-        # Calculate features for all arrows
+            # Calculate features for all arrows
         
-        for feature in [feature for feature in seq_record.features if feature.location.start >= absolute_start and feature.location.end <= absolute_end]:
-            if feature.type == 'CDS':
+            # only check coordinates if we are drawing part of the record
+            if abs_s <= 0 and abs_e >= len(seq_record):
+                features = (f for f in seq_record.features if f.type == 'CDS')
+            else:
+                features = (f for f in seq_record.features if f.type == 'CDS' and f.location.start >= abs_s and f.location.end <= abs_e)
+            
+            for feature in features:
                 # Get name
                 try:
                     GeneName = feature.qualifiers['gene'][0]
@@ -550,7 +643,7 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                     cds_tag += " (" + feature.qualifiers["locus_tag"][0] + ")"
                 if "product" in feature.qualifiers:
                     cds_tag += "\n" + feature.qualifiers["product"][0]
-                    
+                
                 # Get color
                 color = (255,255,255)
                 #try:
@@ -563,8 +656,7 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                 
                 color_contour = (0,0,0)
                 # change to hsv color palette to lower shade for contour color
-                #h_, s, v = rgb_to_hsv(float(color[0])/255.0, float(color[1])/255.0, float(color[2])/255.0)
-                #color_contour = tuple(int(c * 255) for c in hsv_to_rgb(h_, s, 0.4*v))
+                #color_contour = _darken(color, 0.4)
                 
                 # Get strand
                 strand = feature.strand
@@ -577,10 +669,9 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                 
                 # define arrow's start and end
                 # http://biopython.org/DIST/docs/api/Bio.SeqFeature.FeatureLocation-class.html#start
-                start = feature.location.start - absolute_start
-                start = int(start/scaling)
-                stop = feature.location.end - absolute_start
-                stop = int(stop/scaling)
+                f_start = feature.location.start
+                f_end = feature.location.end
+                start = int((f_start - absolute_start)/scaling)
                 
                 # assemble identifier to match domains with this feature
                 try:
@@ -590,7 +681,7 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                     pass
                 identifier = BGCname + "_ORF" + str(feature_counter)
                 identifier += ":gid::" if GeneName == "NoName" else ":gid:" + str(GeneName) + ":"
-                identifier += "pid:" + str(protein_id) + ":loc:" + str(feature.location.start) + ":" + str(feature.location.end)
+                identifier += "pid:" + str(protein_id) + ":loc:" + str(f_start) + ":" + str(f_end)
                 identifier = identifier.replace("<","").replace(">","")
 
                 # gene category according to domain content
@@ -605,7 +696,7 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                         #cat = pfam_domain_categories[dom_acc]
                     #except KeyError:
                         #pass
-                    
+                
                     #if cat == "Core Biosynthetic":
                         #has_core = True
                     #if cat == "Other Biosynthetic":
@@ -614,7 +705,7 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                         #has_transporter = True
                     #if cat == "Regulator":
                         #has_regulator = True
-                            
+                        
                 gene_category = ""
                 #if has_core:
                     #gene_category = "filter=\"url(#shadow_CoreBio)\""
@@ -624,26 +715,27 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
                     #gene_category = "filter=\"url(#shadow_Transporter)\""
                 #if has_regulator and not (has_core or has_otherbio or has_transporter):
                     #gene_category = "filter=\"url(#shadow_Regulator)\""
-                        
+                    
                 
                 #X, Y, L, l, H, h, strand, color, color_contour, category, gid, domain_list
-                arrow = draw_arrow(additional_tabs, start+mX, add_origin_Y+mY+h, int(feature.location.end-feature.location.start)/scaling, l, H, h, strand, color, color_contour, gene_category, cds_tag, identifiers[identifier])
+                arrow = draw_arrow(additional_tabs, start+mX, add_origin_Y+mY+h, int(f_end - f_start)/scaling, l, H, h, strand, color, color_contour, gene_category, cds_tag, identifiers[identifier])
                 if arrow == "":
                     print("  (ArrowerSVG) Warning: something went wrong with {}".format(BGCname))
-                SVG_TEXT += arrow
+                handle.write(arrow)
                 
                 feature_counter += 1
                 
-        loci += 1
+            loci += 1
         
-        SVG_TEXT += additional_tabs + "</g>\n"
+            handle.write(additional_tabs + "</g>\n")
 
-    SVG_TEXT += additional_tabs[:-2] + "</svg>\n"
+        handle.write(additional_tabs[:-2] + "</svg>\n")
     
-    if write_html:
-        SVG_TEXT += "\t\t</div>\n"
+        if write_html:
+            handle.write("\t\t</div>\n")
     
-    # finally append new colors to file:
+    # finally append new colors to file (only when SVG() is used on its own, 
+    # see above):
     #if len(new_color_genes) > 0:
         #if len(new_color_genes) < 10:
             #print("  Saving new color names for genes " + ", ".join(new_color_genes.keys()))
@@ -661,11 +753,6 @@ def SVG(write_html, outputfile, GenBankFile, BGCname, pfdFile, use_pfd, color_ge
             #print("   Saving new color names for 10+ domains")
             
         with open(domains_color_file, "a") as color_domains_handle:
-            for new_names in new_color_domains:
-                color_domains_handle.write(new_names + "\t" + ",".join([str(ncdom) for ncdom in new_color_domains[new_names]]) + "\n")
+            color_domains_handle.writelines(["{}\t{},{},{}\n".format(name, c[0], c[1], c[2]) for name, c in new_color_domains.items()])
 
-    
-    mode = "a" if write_html == True else "w"
-    with open(outputfile, mode) as handle:
-        handle.write(SVG_TEXT)
 
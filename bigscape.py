@@ -46,8 +46,7 @@ import sys
 import time
 from glob import glob
 from itertools import combinations
-from itertools import product as combinations_product
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from multiprocessing import Pool, cpu_count
 from argparse import ArgumentParser
 from difflib import SequenceMatcher
@@ -66,7 +65,7 @@ from ArrowerSVG import *
 
 import numpy as np
 from array import array
-from scipy.sparse import lil_matrix
+from scipy.sparse import lil_matrix, csr_matrix
 from scipy.optimize import linear_sum_assignment
 import json
 import shutil
@@ -81,21 +80,207 @@ global genbankDict
 global valid_classes
 
 
-def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_biosynthetic_genes):
-    """ Given a file path to a GenBank file, reads information about the BGC"""
-
+def read_gbk_data(gbk):
+    """Parses a GenBank file and extracts what process_gbk_files needs from it:
+    BGC properties plus the sequence and coordinates of each CDS. Meant to be 
+    run in a worker process, so only this summary travels back to the main 
+    process, not the parsed records. Returns the summary and, if the file could
+    not be parsed, the error message instead
+    """
+    try:
+        records = list(SeqIO.parse(gbk, "genbank"))
+    except ValueError as e:
+        return None, str(e)
+    
     biosynthetic_genes = set()
     product_list_per_record = []
-    fasta_data = []
-    save_fasta = True
-    adding_sequence = False
     contig_edge = False
-    total_seq_length = 0
     record_end = 0
-    offset_record_position = 0
     bgc_locus_tags = []
     locus_sequences = {}
-    locus_coordinates = {}
+    locus_coordinates = [] # (fasta header, start, end, protein length) of each CDS
+    
+    fname = os.path.basename(gbk)
+    clusterName = fname[:-4]
+    
+    total_seq_length = 0
+    bgc_size = 0
+    cds_ctr = 0
+    offset_record_position = 0
+    
+    max_width = 0 # This will be used for the SVG figure
+    record_count = 0
+    
+    for record in records:
+        record_count += 1
+        bgc_size += len(record.seq)
+        if len(record.seq) > max_width:
+            max_width = len(record.seq)
+        
+        for feature in record.features:
+            # antiSMASH <= 4
+            if feature.type == "cluster":
+                if "product" in feature.qualifiers:
+                    # in antiSMASH 4 there should only be 1 product qualifiers
+                    for product in feature.qualifiers["product"]:
+                        for p in product.replace(" ","").split("-"):
+                            product_list_per_record.append(p)
+                            
+                if "contig_edge" in feature.qualifiers:
+                    # there might be mixed contig_edge annotations
+                    # in multi-record files. Turn on contig_edge when
+                    # there's at least one annotation
+                    if feature.qualifiers["contig_edge"][0] == "True":
+                        if verbose:
+                            print(" Contig edge detected in {}".format(fname))
+                        contig_edge = True
+                    
+            # antiSMASH = 5
+            if "region" in feature.type:
+                if "product" in feature.qualifiers:
+                    for product in feature.qualifiers["product"]:
+                        product_list_per_record.append(product)
+                        
+                if "contig_edge" in feature.qualifiers:
+                    # there might be mixed contig_edge annotations
+                    # in multi-record files. Turn on contig_edge when
+                    # there's at least one annotation
+                    if feature.qualifiers["contig_edge"][0] == "True":
+                        if verbose:
+                            print(" Contig edge detected in {}".format(fname))
+                        contig_edge = True
+                        
+                    
+            # Get biosynthetic genes + sequences
+            if feature.type == "CDS":
+                cds_ctr += 1
+                CDS = feature
+                qualifiers = CDS.qualifiers
+                
+                gene_id = qualifiers.get("gene", [""])[0]
+                protein_id = qualifiers.get("protein_id", [""])[0]
+                
+                # nofuzzy_start/nofuzzy_end are obsolete
+                # http://biopython.org/DIST/docs/api/Bio.SeqFeature.FeatureLocation-class.html#nofuzzy_start
+                gene_start = offset_record_position + max(0, int(CDS.location.start))
+                gene_end = offset_record_position + max(0, int(CDS.location.end))
+                record_end = gene_end
+                
+                direction = CDS.location.strand
+                if direction == 1:
+                    strand = '+'
+                else:
+                    strand = '-'
+                    
+                fasta_header = "{}_ORF{}:gid:{}:pid:{}:loc:{}:{}:strand:{}".format(clusterName, cds_ctr, gene_id.replace(":","_"), protein_id.replace(":","_"), gene_start, gene_end, strand)
+                # the coordinates might contain larger than signs, tools upstream don't like this
+                # the domtable output format (hmmscan) uses spaces as a delimiter, so these cannot be present in the fasta header
+                fasta_header = fasta_header.replace(">","").replace(" ", "")
+
+                # antiSMASH <=4
+                if "sec_met" in qualifiers:
+                    if "Kind: biosynthetic" in qualifiers["sec_met"]:
+                        biosynthetic_genes.add(fasta_header)
+
+                # antiSMASH == 5
+                if "gene_kind" in qualifiers:
+                    if "biosynthetic" in qualifiers["gene_kind"]:
+                        biosynthetic_genes.add(fasta_header)
+                
+                fasta_header = ">"+fasta_header
+                
+
+                translation = qualifiers.get("translation")
+                if translation:
+                    prot_seq = translation[0]
+                # If translation isn't available translate manually, this will take longer
+                else:
+                    nt_seq = CDS.location.extract(record.seq)
+                    
+                    # If we know sequence is an ORF (like all CDSs), codon table can be
+                    #  used to correctly translate alternative start codons.
+                    #  see http://biopython.org/DIST/docs/tutorial/Tutorial.html#htoc25
+                    # If the sequence has a fuzzy start/end, it might not be complete,
+                    # (therefore it might not be the true start codon)
+                    # However, in this case, if 'translation' not available, assume 
+                    #  this is just a random sequence 
+                    complete_cds = False 
+                    
+                    # More about fuzzy positions
+                    # http://biopython.org/DIST/docs/tutorial/Tutorial.html#htoc39
+                    fuzzy_start = False 
+                    if str(CDS.location.start)[0] in "<>":
+                        complete_cds = False
+                        fuzzy_start = True
+                        
+                    fuzzy_end = False
+                    if str(CDS.location.end)[0] in "<>":
+                        fuzzy_end = True
+                    
+                    #for protein sequence if it is at the start of the entry assume 
+                    # that end of sequence is in frame and trim from the beginning
+                    #if it is at the end of the genbank entry assume that the start 
+                    # of the sequence is in frame
+                    reminder = len(nt_seq)%3
+                    if reminder > 0:
+                        if fuzzy_start and fuzzy_end:
+                            print("Warning, CDS ({}, {}) has fuzzy\
+                                start and end positions, and a \
+                                sequence length not multiple of \
+                                three. Skipping".format(clusterName, 
+                                CDS.qualifiers.get('locus_tag',"")[0]))
+                            break
+                        
+                        if fuzzy_start:
+                            nt_seq = nt_seq[reminder:]
+                        # fuzzy end
+                        else:
+                            #same logic reverse direction
+                            nt_seq = nt_seq[:-reminder]
+                    
+                    # The Genetic Codes: www.ncbi.nlm.nih.gov/Taxonomy/Utils/wprintgc.cgi
+                    if "transl_table" in CDS.qualifiers:
+                        CDStable = CDS.qualifiers.get("transl_table", "")[0]
+                        prot_seq = str(nt_seq.translate(table=CDStable, to_stop=True, cds=complete_cds))
+                    else:
+                        prot_seq = str(nt_seq.translate(to_stop=True, cds=complete_cds))
+                        
+                total_seq_length += len(prot_seq)
+            
+            
+                bgc_locus_tags.append(fasta_header)
+                locus_sequences[fasta_header] = prot_seq
+                locus_coordinates.append((fasta_header, gene_start, gene_end, len(prot_seq)))
+                
+
+        # TODO: if len(biosynthetic_genes) == 0, traverse record again
+        # and add CDS with genes that contain domains labeled sec_met
+        # we'll probably have to have a list of domains if we allow
+        # fasta files as input
+        
+        # make absolute positions for ORFs in next records
+        offset_record_position += record_end + 100
+    
+    # assuming that the definition field is the same in all records
+    if record_count > 0:
+        annotations = records[0].annotations
+        first_record = (records[0].id, records[0].description, 
+            {key: annotations[key] for key in ("organism", "taxonomy") if key in annotations})
+    else:
+        first_record = None
+    
+    return (first_record, record_count, max_width, bgc_size, 
+        product_list_per_record, contig_edge, biosynthetic_genes, 
+        bgc_locus_tags, locus_sequences, locus_coordinates, 
+        total_seq_length), None
+
+
+def process_gbk_files(gbk, parsed_gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_biosynthetic_genes):
+    """ Given a file path to a GenBank file and the data extracted from it (as 
+    returned by read_gbk_data), reads information about the BGC"""
+
+    save_fasta = True
+    adding_sequence = False
     
     file_folder, fname = os.path.split(gbk)
     clusterName = fname[:-4]
@@ -111,181 +296,18 @@ def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_b
     else:
         save_fasta = True
     
-    try:
-        # basic file verification. Substitutes check_data_integrity
-        records = list(SeqIO.parse(gbk, "genbank"))
-    except ValueError as e:
-        print("   Error with file {}: \n    '{}'".format(gbk, str(e)))
+    # basic file verification. Substitutes check_data_integrity
+    gbk_data, parse_error = parsed_gbk
+    if parse_error is not None:
+        print("   Error with file {}: \n    '{}'".format(gbk, parse_error))
         print("    (This file will be excluded from the analysis)")
         return
     else:
-        total_seq_length = 0
-        bgc_size = 0
-        cds_ctr = 0
+        (first_record, record_count, max_width, bgc_size, 
+            product_list_per_record, contig_edge, biosynthetic_genes, 
+            bgc_locus_tags, locus_sequences, locus_coordinates, 
+            total_seq_length) = gbk_data
         product = "no type"
-        offset_record_position = 0
-        
-        max_width = 0 # This will be used for the SVG figure
-        record_count = 0
-        
-        for record in records:
-            record_count += 1
-            bgc_size += len(record.seq)
-            if len(record.seq) > max_width:
-                max_width = len(record.seq)
-            
-            for feature in record.features:
-                # antiSMASH <= 4
-                if feature.type == "cluster":
-                    if "product" in feature.qualifiers:
-                        # in antiSMASH 4 there should only be 1 product qualifiers
-                        for product in feature.qualifiers["product"]:
-                            for p in product.replace(" ","").split("-"):
-                                product_list_per_record.append(p)
-                                
-                    if "contig_edge" in feature.qualifiers:
-                        # there might be mixed contig_edge annotations
-                        # in multi-record files. Turn on contig_edge when
-                        # there's at least one annotation
-                        if feature.qualifiers["contig_edge"][0] == "True":
-                            if verbose:
-                                print(" Contig edge detected in {}".format(fname))
-                            contig_edge = True
-                        
-                # antiSMASH = 5
-                if "region" in feature.type:
-                    if "product" in feature.qualifiers:
-                        for product in feature.qualifiers["product"]:
-                            product_list_per_record.append(product)
-                            
-                    if "contig_edge" in feature.qualifiers:
-                        # there might be mixed contig_edge annotations
-                        # in multi-record files. Turn on contig_edge when
-                        # there's at least one annotation
-                        if feature.qualifiers["contig_edge"][0] == "True":
-                            if verbose:
-                                print(" Contig edge detected in {}".format(fname))
-                            contig_edge = True
-                            
-                        
-                # Get biosynthetic genes + sequences
-                if feature.type == "CDS":
-                    cds_ctr += 1
-                    CDS = feature
-                    
-                    gene_id = ""
-                    if "gene" in CDS.qualifiers:
-                        gene_id = CDS.qualifiers.get('gene',"")[0]
-                        
-                    
-                    protein_id = ""
-                    if "protein_id" in CDS.qualifiers:
-                        protein_id = CDS.qualifiers.get('protein_id',"")[0]
-                    
-                    # nofuzzy_start/nofuzzy_end are obsolete
-                    # http://biopython.org/DIST/docs/api/Bio.SeqFeature.FeatureLocation-class.html#nofuzzy_start
-                    gene_start = offset_record_position + max(0, int(CDS.location.start))
-                    gene_end = offset_record_position + max(0, int(CDS.location.end))
-                    record_end = gene_end
-                    
-                    direction = CDS.location.strand
-                    if direction == 1:
-                        strand = '+'
-                    else:
-                        strand = '-'
-                        
-                    fasta_header = "{}_ORF{}:gid:{}:pid:{}:loc:{}:{}:strand:{}".format(clusterName, str(cds_ctr), str(gene_id).replace(":","_"), str(protein_id).replace(":","_"), str(gene_start), str(gene_end), strand)
-                    fasta_header = fasta_header.replace(">","") #the coordinates might contain larger than signs, tools upstream don't like this
-                    fasta_header = fasta_header.replace(" ", "") #the domtable output format (hmmscan) uses spaces as a delimiter, so these cannot be present in the fasta header
-
-                    # antiSMASH <=4
-                    if "sec_met" in feature.qualifiers:
-                        if "Kind: biosynthetic" in feature.qualifiers["sec_met"]:
-                            biosynthetic_genes.add(fasta_header)
-
-                    # antiSMASH == 5
-                    if "gene_kind" in feature.qualifiers:
-                        if "biosynthetic" in feature.qualifiers["gene_kind"]:
-                            biosynthetic_genes.add(fasta_header)
-                    
-                    fasta_header = ">"+fasta_header
-                    
-
-                    if 'translation' in CDS.qualifiers.keys():
-                        prot_seq = CDS.qualifiers['translation'][0]
-                    # If translation isn't available translate manually, this will take longer
-                    else:
-                        nt_seq = CDS.location.extract(record.seq)
-                        
-                        # If we know sequence is an ORF (like all CDSs), codon table can be
-                        #  used to correctly translate alternative start codons.
-                        #  see http://biopython.org/DIST/docs/tutorial/Tutorial.html#htoc25
-                        # If the sequence has a fuzzy start/end, it might not be complete,
-                        # (therefore it might not be the true start codon)
-                        # However, in this case, if 'translation' not available, assume 
-                        #  this is just a random sequence 
-                        complete_cds = False 
-                        
-                        # More about fuzzy positions
-                        # http://biopython.org/DIST/docs/tutorial/Tutorial.html#htoc39
-                        fuzzy_start = False 
-                        if str(CDS.location.start)[0] in "<>":
-                            complete_cds = False
-                            fuzzy_start = True
-                            
-                        fuzzy_end = False
-                        if str(CDS.location.end)[0] in "<>":
-                            fuzzy_end = True
-                        
-                        #for protein sequence if it is at the start of the entry assume 
-                        # that end of sequence is in frame and trim from the beginning
-                        #if it is at the end of the genbank entry assume that the start 
-                        # of the sequence is in frame
-                        reminder = len(nt_seq)%3
-                        if reminder > 0:
-                            if fuzzy_start and fuzzy_end:
-                                print("Warning, CDS ({}, {}) has fuzzy\
-                                    start and end positions, and a \
-                                    sequence length not multiple of \
-                                    three. Skipping".format(clusterName, 
-                                    CDS.qualifiers.get('locus_tag',"")[0]))
-                                break
-                            
-                            if fuzzy_start:
-                                if reminder == 1:
-                                    nt_seq = nt_seq[1:]
-                                else:
-                                    nt_seq = nt_seq[2:]
-                            # fuzzy end
-                            else:
-                                #same logic reverse direction
-                                if reminder == 1:
-                                    nt_seq = nt_seq[:-1]
-                                else:
-                                    nt_seq = nt_seq[:-2]
-                        
-                        # The Genetic Codes: www.ncbi.nlm.nih.gov/Taxonomy/Utils/wprintgc.cgi
-                        if "transl_table" in CDS.qualifiers.keys():
-                            CDStable = CDS.qualifiers.get("transl_table", "")[0]
-                            prot_seq = str(nt_seq.translate(table=CDStable, to_stop=True, cds=complete_cds))
-                        else:
-                            prot_seq = str(nt_seq.translate(to_stop=True, cds=complete_cds))
-                            
-                    total_seq_length += len(prot_seq)
-                
-                
-                    bgc_locus_tags.append(fasta_header)
-                    locus_sequences[fasta_header] = prot_seq
-                    locus_coordinates[fasta_header] = (gene_start, gene_end, len(prot_seq))
-                    
-
-            # TODO: if len(biosynthetic_genes) == 0, traverse record again
-            # and add CDS with genes that contain domains labeled sec_met
-            # we'll probably have to have a list of domains if we allow
-            # fasta files as input
-            
-            # make absolute positions for ORFs in next records
-            offset_record_position += record_end + 100
         
         if bgc_size > min_bgc_size:  # exclude the bgc if it's too small
             # check what we have product-wise
@@ -325,15 +347,16 @@ def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_b
             # Perhaps we can try to infer if it's in a contig edge: if
             # - first biosynthetic gene start < 10kb or
             # - max_width - last biosynthetic gene end < 10kb (but this will work only for the largest record)
-            bgc_info[clusterName] = bgc_data(records[0].id, records[0].description, product, len(records), max_width, bgc_size + (record_count-1)*1000, records[0].annotations["organism"], ",".join(records[0].annotations["taxonomy"]), biosynthetic_genes.copy(), contig_edge)
+            record_id, definition, annotations = first_record
+            bgc_info[clusterName] = bgc_data(record_id, definition, product, record_count, max_width, bgc_size + (record_count-1)*1000, annotations["organism"], ",".join(annotations["taxonomy"]), biosynthetic_genes.copy(), contig_edge)
 
             if len(bgc_info[clusterName].biosynthetic_genes) == 0:
                 files_no_biosynthetic_genes.append(clusterName+".gbk")
 
             # TODO why re-process everything if it was already in the list?
-            # if name already in genbankDict.keys -> add file_folder
+            # if name already in genbankDict -> add file_folder
             # else: extract all info
-            if clusterName in genbankDict.keys():
+            if clusterName in genbankDict:
                 # Name was already in use. Use file_folder as the new sample's name
                 genbankDict[clusterName][1].add(file_folder) 
             else:
@@ -355,10 +378,7 @@ def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_b
                         # TODO what are the characterized differences in prokarytote
                         #  vs eukaryote CDS overlap?
                         del_list = set()
-                        for a, b in combinations(bgc_locus_tags, 2):
-                            a_start, a_end, a_len = locus_coordinates[a]
-                            b_start, b_end, b_len = locus_coordinates[b]
-                            
+                        for (a, a_start, a_end, a_len), (b, b_start, b_end, b_len) in combinations(locus_coordinates, 2):
                             if b_end <= a_start or b_start >= a_end:
                                 pass
                             else:
@@ -391,9 +411,7 @@ def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_b
                             bgc_locus_tags.remove(locus)
                         
                         with open(outputfile,'w') as fastaHandle:
-                            for locus in bgc_locus_tags:
-                                fastaHandle.write("{}\n".format(locus))
-                                fastaHandle.write("{}\n".format(locus_sequences[locus]))
+                            fastaHandle.write("".join(["{}\n{}\n".format(locus, locus_sequences[locus]) for locus in bgc_locus_tags]))
                             adding_sequence = True
                 else:
                     files_no_proteins.append(fname)
@@ -407,6 +425,29 @@ def process_gbk_files(gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_b
     return adding_sequence
 
 
+def iter_gbk_files(inputpath):
+    """Yields the paths of all .gbk files found under inputpath (recursively).
+    Uses os.scandir where available: the directory entries already know 
+    whether they are folders, so no extra stat calls are needed
+    """
+    try:
+        scandir = os.scandir
+    except AttributeError: # Python 2
+        for dirpath, dirnames, files in os.walk(inputpath):
+            for f in files:
+                if f.endswith(".gbk"):
+                    yield os.path.join(dirpath, f)
+        return
+    
+    stack = [inputpath]
+    while stack:
+        for entry in scandir(stack.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif entry.name.endswith(".gbk") and not entry.is_dir():
+                yield entry.path
+
+
 def get_gbk_files(inputpath, outputdir, bgc_fasta_folder, min_bgc_size, include_gbk_str, exclude_gbk_str, bgc_info):
     """Searches given directory for genbank files recursively, will assume that
     the genbank files that have the same name are the same genbank file. 
@@ -428,19 +469,18 @@ def get_gbk_files(inputpath, outputdir, bgc_fasta_folder, min_bgc_size, include_
     else:
         # Unfortunately, this does not work in Python 2:
         #files = glob(os.path.join(inputpath,"**/*.gbk"), recursive=True) 
-        files = [os.path.join(dirpath, f) for dirpath, dirnames, files in os.walk(inputpath)
-                 for f in files if f.endswith(".gbk")]
+        files = iter_gbk_files(inputpath)
         
+    include_all = len(include_gbk_str) == 1 and include_gbk_str[0] == "*"
+    gbk_paths = []
     for filepath in files:
         file_folder, fname = os.path.split(filepath)
         
-        if len(include_gbk_str) == 1 and include_gbk_str[0] == "*":
-            pass
-        else:
-            if not any([word in fname for word in include_gbk_str]):
+        if not include_all:
+            if not any(word in fname for word in include_gbk_str):
                 continue
             
-            if exclude_gbk_str != [] and any([word in fname for word in exclude_gbk_str]):
+            if exclude_gbk_str != [] and any(word in fname for word in exclude_gbk_str):
                 print(" Skipping file " + fname)
                 continue
         
@@ -451,10 +491,27 @@ def get_gbk_files(inputpath, outputdir, bgc_fasta_folder, min_bgc_size, include_
         if " " in filepath:
             sys.exit("\nError: Input GenBank files should not have spaces in their path as hmmscan cannot process them properly ('too many arguments').")
         
+        gbk_paths.append(filepath)
+    
+    # Parsing the GenBank files is the expensive part: do it in parallel. The
+    # records come back in order, so the BGCs are processed in the same order
+    # as with a single process
+    if cores > 1 and len(gbk_paths) > 1:
+        pool = Pool(cores)
+        parsed_gbks = pool.imap(read_gbk_data, gbk_paths, max(1, min(16, len(gbk_paths)//(cores*4))))
+    else:
+        pool = None
+        parsed_gbks = (read_gbk_data(filepath) for filepath in gbk_paths)
+    
+    for filepath, parsed_gbk in zip(gbk_paths, parsed_gbks):
         file_counter += 1
-        if process_gbk_files(filepath, min_bgc_size, bgc_info, files_no_proteins, files_no_biosynthetic_genes):
+        if process_gbk_files(filepath, parsed_gbk, min_bgc_size, bgc_info, files_no_proteins, files_no_biosynthetic_genes):
             processed_sequences += 1
     
+    if pool is not None:
+        pool.close()
+        pool.join()
+    
     if len(files_no_proteins) > 0:
         print("  Warning: Input set has files without protein sequences. They will be discarded")
         print("   (See no_sequences_list.txt)")
@@ -498,16 +555,31 @@ def timeit(funct):
 
 
 @timeit
-def generate_network(cluster_pairs, cores):
+def generate_network(cluster_pairs, pool):
     """Distributes the distance calculation part
     cluster_pairs is a list of triads (cluster1_index, cluster2_index, BGC class)
+    pool is the multiprocessing Pool shared by all network calculations
     """
     
-    pool = Pool(cores, maxtasksperchild=100)
+    # Pairs of BGCs that don't share a single domain need no sequence work at
+    # all. Spot them here and only send the rest to the workers
+    unrelated, domain_counts = find_unrelated_pairs(cluster_pairs)
+    related_pairs = [pair for pair, skip in zip(cluster_pairs, unrelated) if not skip]
     
     #Assigns the data to the different workers and pools the results back into
     # the network_matrix variable
-    network_matrix = pool.map(generate_dist_matrix, cluster_pairs)
+    related_rows = iter(pool.map(generate_dist_matrix, related_pairs))
+    network_matrix = []
+    for pair, skip in zip(cluster_pairs, unrelated):
+        if skip:
+            cluster1Idx, cluster2Idx = int(pair[0]), int(pair[1])
+            S_a, S_anchor_a = domain_counts[cluster1Idx]
+            S_b, S_anchor_b = domain_counts[cluster2Idx]
+            # same values cluster_distance_lcs reports for unrelated pairs
+            network_matrix.append(array('f',[cluster1Idx, cluster2Idx, 1, 0, 0,
+                0, 0, 1, 1, S_a + S_b, S_anchor_a + S_anchor_b, 0, 0, 0, 0]))
+        else:
+            network_matrix.append(next(related_rows))
 
     # --- Serialized version of distance calculation ---
     # For the time being, use this if you have memory issues
@@ -518,6 +590,61 @@ def generate_network(cluster_pairs, cores):
     return network_matrix
 
 
+def find_unrelated_pairs(cluster_pairs):
+    """Flags the pairs of BGCs (triads, as in cluster_pairs) that don't share 
+    any domain.
+    Shared domains are counted with a sparse (BGC x domain) presence matrix, 
+    a chunk of pairs at a time to keep memory in check. 
+    Pairs with a BGC without a known domain list are never flagged
+    
+    Output:
+    list of flags, one per pair
+    dictionary. Key: BGC index. Item: (non-anchor, anchor) domain counts
+    """
+    row_of = {}
+    domain_col = {}
+    rows = []
+    cols = []
+    for clusterIdx in sorted(set(int(c) for pair in cluster_pairs for c in pair[:2])):
+        domain_list = DomainList.get(clusterNames[clusterIdx])
+        if not domain_list:
+            continue
+        row_of[clusterIdx] = len(row_of)
+        for domain in set(domain_list):
+            rows.append(row_of[clusterIdx])
+            cols.append(domain_col.setdefault(domain, len(domain_col)))
+    
+    presence = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), 
+        shape=(len(row_of), len(domain_col)))
+    
+    pair_a = np.array([row_of.get(int(pair[0]), -1) for pair in cluster_pairs], dtype=np.int32)
+    pair_b = np.array([row_of.get(int(pair[1]), -1) for pair in cluster_pairs], dtype=np.int32)
+    known = np.flatnonzero((pair_a >= 0) & (pair_b >= 0))
+    
+    # the number of shared domains of a pair is the dot product of both rows
+    unrelated = np.zeros(len(cluster_pairs), dtype=bool)
+    chunk = 65536
+    for start in range(0, len(known), chunk):
+        pairs_idx = known[start:start+chunk]
+        shared = presence[pair_a[pairs_idx]].multiply(presence[pair_b[pairs_idx]]).sum(axis=1)
+        unrelated[pairs_idx] = np.asarray(shared).ravel() == 0
+    
+    # the number of domains is reported in the network file even for 
+    # unrelated pairs
+    domain_counts = {}
+    for clusterIdx in row_of:
+        cluster = clusterNames[clusterIdx]
+        S, S_anchor = 0, 0
+        for domain in set(DomainList[cluster]):
+            if domain in anchor_domain_names:
+                S_anchor += len(BGCs[cluster][domain])
+            else:
+                S += len(BGCs[cluster][domain])
+        domain_counts[clusterIdx] = (S, S_anchor)
+    
+    return unrelated.tolist(), domain_counts
+
+
 def generate_dist_matrix(parms):
     """Unpack data to actually launch cluster_distance for one pair of BGCs"""
     
@@ -532,11 +659,15 @@ def generate_dist_matrix(parms):
     except KeyError:
         print(" Warning: domain list for {} or {} was not found. Extracting from pfs files".format(cluster1, cluster2))
         
-        cluster_file1 = os.path.join(output_folder, cluster1 + ".pfs")
-        cluster_file2 = os.path.join(output_folder, cluster2 + ".pfs")
+        cluster_file1 = os.path.join(pfs_folder, cluster1 + ".pfs")
+        cluster_file2 = os.path.join(pfs_folder, cluster2 + ".pfs")
         
         domain_list_A = get_domain_list(cluster_file1)
         domain_list_B = get_domain_list(cluster_file2)
+        
+        # keep them for the next pairs with these BGCs handled by this process
+        DomainList[cluster1] = domain_list_A
+        DomainList[cluster2] = domain_list_B
     
     # this really shouldn't happen if we've filtered domain-less gene clusters already
     if len(domain_list_A) == 0 or len(domain_list_B) == 0:
@@ -639,6 +770,70 @@ def score_expansion(x_string_, y_string_, downstream):
     return max_score, a
 
 
+def aligned_distance_matrix(aligned_seqs_a, aligned_seqs_b):
+    """Distance (1 - identity) between every pair of sequences from two lists
+    of aligned sequences, all of the same length. Positions where both
+    sequences have a gap are not counted
+    """
+    seqs_a = np.array([np.frombuffer(seq.encode("ascii"), dtype=np.uint8) for seq in aligned_seqs_a])
+    seqs_b = np.array([np.frombuffer(seq.encode("ascii"), dtype=np.uint8) for seq in aligned_seqs_b])
+    
+    # shape: (copies in a, copies in b, alignment length)
+    same = seqs_a[:, None, :] == seqs_b[None, :, :]
+    gap_a = (seqs_a == ord("-"))[:, None, :]
+    gaps = (same & gap_a).sum(axis=2)
+    matches = same.sum(axis=2) - gaps
+    
+    return 1 - matches/(seqs_a.shape[1] - gaps)
+
+
+def aligned_distance(aligned_seq_a, aligned_seq_b):
+    """Distance (1 - identity) between two aligned sequences. If their lengths
+    differ, only the common part is compared. Positions where both sequences
+    have a gap are not counted
+    """
+    seq_length = min(len(aligned_seq_a), len(aligned_seq_b))
+    seq_a = np.frombuffer(aligned_seq_a[:seq_length].encode("ascii"), dtype=np.uint8)
+    seq_b = np.frombuffer(aligned_seq_b[:seq_length].encode("ascii"), dtype=np.uint8)
+    
+    same = seq_a == seq_b
+    gaps = int((same & (seq_a == ord("-"))).sum())
+    matches = int(same.sum()) - gaps
+    
+    return 1 - matches/(seq_length - gaps)
+
+
+class LRUCache(object):
+    """Dictionary-like cache that only keeps the maxsize most recently used 
+    items (functools.lru_cache is not available in Python 2). A missing key 
+    raises KeyError, like in a dictionary"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        
+    def __getitem__(self, key):
+        # move the item to the end: it is now the most recently used
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+    
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+
+# Pairwise alignments made when a domain's multiple alignment is missing, and
+# the domain fasta files read for them. Each worker process keeps its own.
+# Alignments are keyed by the sequences themselves, so an alignment is only 
+# reused when the same two BGCs are compared again (e.g. in another network 
+# type) or when identical domain sequences show up in other BGCs
+pairwise_alignments = LRUCache(10000)
+# a domain fasta file can hold thousands of sequences: keep only a few
+domain_fasta_cache = LRUCache(32)
+
+
 def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, core_pos_b, go_A, go_b, bgc_class):
     """Compare two clusters using information on their domains, and the 
     sequences of the domains. 
@@ -661,8 +856,6 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
     
     Jaccardw, DSSw, AIw, anchorboost = bgc_class_weight[bgc_class]
 
-    temp_domain_fastas = {}
-    
     # Number of genes in each BGC
     lenG_A = len(dcg_A)
     lenG_B = len(dcg_b)
@@ -686,16 +879,15 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
         # Count total number of anchor and non-anchor domain to report in the 
         # network file. Apart from that, these BGCs are totally unrelated.
         for domain in setA:
-            # This is a bit of a hack. If pfam domain ids ever change in size
-            # we'd be in trouble. The previous approach was to .split(".")[0]
-            # but it's more costly
-            if domain[:7] in anchor_domains:
+            # anchor_domain_names has the full names (with version), so there's
+            # no need to .split(".")[0] every domain
+            if domain in anchor_domain_names:
                 S_anchor += len(BGCs[A][domain])
             else:
                 S += len(BGCs[A][domain])
                 
         for domain in setB:
-            if domain[:7] in anchor_domains:
+            if domain in anchor_domain_names:
                 S_anchor += len(BGCs[B][domain])
             else:
                 S += len(BGCs[B][domain])
@@ -1014,7 +1206,8 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
                 #print(" - - Not a valid overlap found - - (shortest slice not large enough)\n")
                     
     # JACCARD INDEX
-    Jaccard = len(intersect) / len(setA | setB)
+    # |A u B| = |A| + |B| - |A n B|: no need to build the union
+    Jaccard = len(intersect) / (len(setA) + len(setB) - len(intersect))
 
 
     # DSS INDEX
@@ -1040,8 +1233,8 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
         except KeyError:
             num_unshared = B_domain_sequence_slice_top[unshared_domain] - B_domain_sequence_slice_bottom[unshared_domain]
             
-        # don't look at domain version, hence the split
-        if unshared_domain[:7] in anchor_domains:
+        # anchor_domain_names already accounts for the domain versions
+        if unshared_domain in anchor_domain_names:
             domain_difference_anchor += num_unshared
         else:
             domain_difference += num_unshared
@@ -1058,72 +1251,74 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
         num_copies_a = A_domain_sequence_slice_top[shared_domain] - A_domain_sequence_slice_bottom[shared_domain]
         num_copies_b = B_domain_sequence_slice_top[shared_domain] - B_domain_sequence_slice_bottom[shared_domain]
         
-        temp_domain_fastas.clear()
-        
         accumulated_distance = 0
             
         # Fill distance matrix between domain's A and B versions
-        DistanceMatrix = np.ndarray((num_copies_a,num_copies_b))
-        for domsa in range(num_copies_a):
-            for domsb in range(num_copies_b):
-                sequence_tag_a = specific_domain_list_A[domsa + A_domain_sequence_slice_bottom[shared_domain]]
-                sequence_tag_b = specific_domain_list_B[domsb + B_domain_sequence_slice_bottom[shared_domain]]
-                
-                seq_length = 0
-                matches = 0
-                gaps = 0
-                
-                try:
-                    aligned_seqA = AlignedDomainSequences[sequence_tag_a]
-                    aligned_seqB = AlignedDomainSequences[sequence_tag_b]
-                    
-                except KeyError:
-                    # For some reason we don't have the multiple alignment files. 
-                    # Try manual alignment
-                    if shared_domain not in missing_aligned_domain_files and verbose:
-                        # this will print everytime an unfound <domain>.algn is not found for every
-                        # distance calculation (but at least, not for every domain pair!)
-                        print("  Warning: {}.algn not found. Trying pairwise alignment...".format(shared_domain))
-                        missing_aligned_domain_files.append(shared_domain)
-                    
+        # Usual case: all copies are in the multiple alignment. Compare them all at once
+        DistanceMatrix = None
+        try:
+            aligned_seqs_a = [AlignedDomainSequences[tag] for tag in specific_domain_list_A[A_domain_sequence_slice_bottom[shared_domain]:A_domain_sequence_slice_bottom[shared_domain]+num_copies_a]]
+            aligned_seqs_b = [AlignedDomainSequences[tag] for tag in specific_domain_list_B[B_domain_sequence_slice_bottom[shared_domain]:B_domain_sequence_slice_bottom[shared_domain]+num_copies_b]]
+        except KeyError:
+            pass
+        else:
+            if len(set(len(seq) for seq in aligned_seqs_a + aligned_seqs_b)) == 1:
+                DistanceMatrix = aligned_distance_matrix(aligned_seqs_a, aligned_seqs_b)
+        
+        # Otherwise, go pair by pair (pairwise alignment if needed)
+        if DistanceMatrix is None:
+            DistanceMatrix = np.ndarray((num_copies_a,num_copies_b))
+            for domsa in range(num_copies_a):
+                for domsb in range(num_copies_b):
+                    sequence_tag_a = specific_domain_list_A[domsa + A_domain_sequence_slice_bottom[shared_domain]]
+                    sequence_tag_b = specific_domain_list_B[domsb + B_domain_sequence_slice_bottom[shared_domain]]
+                
                     try:
-                        unaligned_seqA = temp_domain_fastas[sequence_tag_a]
-                        unaligned_seqB = temp_domain_fastas[sequence_tag_b]
+                        aligned_seqA = AlignedDomainSequences[sequence_tag_a]
+                        aligned_seqB = AlignedDomainSequences[sequence_tag_b]
+                    
                     except KeyError:
-                        # parse the file for the first time and load all the sequences
-                        with open(os.path.join(domains_folder, shared_domain + ".fasta"),"r") as domain_fasta_handle:
-                            temp_domain_fastas = fasta_parser(domain_fasta_handle)
+                        # For some reason we don't have the multiple alignment files. 
+                        # Try manual alignment
+                        if shared_domain not in missing_aligned_domain_files and verbose:
+                            # this will print everytime an unfound <domain>.algn is not found for every
+                            # distance calculation (but at least, not for every domain pair!)
+                            print("  Warning: {}.algn not found. Trying pairwise alignment...".format(shared_domain))
+                            missing_aligned_domain_files.append(shared_domain)
+                    
+                        try:
+                            domain_fastas = domain_fasta_cache[shared_domain]
+                        except KeyError:
+                            # parse the file for the first time and load all the sequences
+                            with open(os.path.join(domains_folder, shared_domain + ".fasta"),"r") as domain_fasta_handle:
+                                domain_fastas = fasta_parser(domain_fasta_handle)
+                            domain_fasta_cache[shared_domain] = domain_fastas
                         
-                        unaligned_seqA = temp_domain_fastas[sequence_tag_a]
-                        unaligned_seqB = temp_domain_fastas[sequence_tag_b]
+                        unaligned_seqA = domain_fastas[sequence_tag_a]
+                        unaligned_seqB = domain_fastas[sequence_tag_b]
                         
-                    # gap_open = -15
-                    # gap_extend = -6.67. These parameters were set up by Emzo
-                    alignScore = pairwise2.align.globalds(unaligned_seqA, unaligned_seqB, scoring_matrix, -15, -6.67, one_alignment_only=True)
-                    bestAlignment = alignScore[0]
-                    aligned_seqA = bestAlignment[0]
-                    aligned_seqB = bestAlignment[1]
+                        # reuse the alignment if these exact sequences were aligned before
+                        try:
+                            aligned_seqA, aligned_seqB = pairwise_alignments[(unaligned_seqA, unaligned_seqB)]
+                        except KeyError:
+                            # gap_open = -15
+                            # gap_extend = -6.67. These parameters were set up by Emzo
+                            alignScore = pairwise2.align.globalds(unaligned_seqA, unaligned_seqB, scoring_matrix, -15, -6.67, one_alignment_only=True)
+                            bestAlignment = alignScore[0]
+                            aligned_seqA = bestAlignment[0]
+                            aligned_seqB = bestAlignment[1]
+                            pairwise_alignments[(unaligned_seqA, unaligned_seqB)] = (aligned_seqA, aligned_seqB)
                     
                     
-                # - Calculate aligned domain sequences similarity -
-                # Sequences *should* be of the same length unless something went
-                # wrong elsewhere
-                if len(aligned_seqA) != len(aligned_seqB):
-                    print("\tWARNING: mismatch in sequences' lengths while calculating sequence identity ({})".format(shared_domain))
-                    print("\t  Specific domain 1: {} len: {}".format(sequence_tag_a, str(len(aligned_seqA))))
-                    print("\t  Specific domain 2: {} len: {}".format(sequence_tag_b, str(len(aligned_seqB))))
-                    seq_length = min(len(aligned_seqA), len(aligned_seqB))
-                else:
-                    seq_length = len(aligned_seqA)
+                    # - Calculate aligned domain sequences similarity -
+                    # Sequences *should* be of the same length unless something went
+                    # wrong elsewhere
+                    if len(aligned_seqA) != len(aligned_seqB):
+                        print("\tWARNING: mismatch in sequences' lengths while calculating sequence identity ({})".format(shared_domain))
+                        print("\t  Specific domain 1: {} len: {}".format(sequence_tag_a, str(len(aligned_seqA))))
+                        print("\t  Specific domain 2: {} len: {}".format(sequence_tag_b, str(len(aligned_seqB))))
                     
-                for position in range(seq_length):
-                    if aligned_seqA[position] == aligned_seqB[position]:
-                        if aligned_seqA[position] != "-":
-                            matches += 1
-                        else:
-                            gaps += 1
-                            
-                DistanceMatrix[domsa][domsb] = 1 - ( matches/(seq_length-gaps) )
+                    DistanceMatrix[domsa][domsb] = aligned_distance(aligned_seqA, aligned_seqB)
                 
         #Only use the best scoring pairs
         BestIndexes = linear_sum_assignment(DistanceMatrix)
@@ -1133,7 +1328,7 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
         sum_seq_dist = (abs(num_copies_a-num_copies_b) + accumulated_distance)  #essentially 1-sim
         normalization_element = max(num_copies_a, num_copies_b)
             
-        if shared_domain[:7] in anchor_domains:
+        if shared_domain in anchor_domain_names:
             S_anchor += normalization_element
             domain_difference_anchor += sum_seq_dist
         else:
@@ -1176,16 +1371,13 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
     if len(A_domlist[domA_start:domA_end]) < 2 or len(B_domlist[domB_start:domB_end]) < 2:
         AI = 0.0
     else:
-        setA_pairs = set()
-        for l in range(domA_start, domA_end-1):
-            setA_pairs.add(tuple(sorted([A_domlist[l],A_domlist[l+1]])))
-        
-        setB_pairs = set()
-        for l in range(domB_start, domB_end-1):
-            setB_pairs.add(tuple(sorted([B_domlist[l],B_domlist[l+1]])))
+        # pairs of neighbouring domains, order within the pair doesn't matter
+        setA_pairs = set((x, y) if x <= y else (y, x) for x, y in zip(A_domlist[domA_start:domA_end-1], A_domlist[domA_start+1:domA_end]))
+        setB_pairs = set((x, y) if x <= y else (y, x) for x, y in zip(B_domlist[domB_start:domB_end-1], B_domlist[domB_start+1:domB_end]))
 
         # same treatment as in Jaccard
-        AI = len(setA_pairs & setB_pairs) / len(setA_pairs | setB_pairs)
+        shared_pairs = len(setA_pairs & setB_pairs)
+        AI = shared_pairs / (len(setA_pairs) + len(setB_pairs) - shared_pairs)
 
     Distance = 1 - (Jaccardw * Jaccard) - (DSSw * DSS) - (AIw * AI)
     
@@ -1205,13 +1397,21 @@ def cluster_distance_lcs(A, B, A_domlist, B_domlist, dcg_A, dcg_b, core_pos_A, c
         
     return Distance, Jaccard, DSS, AI, DSS_non_anchor, DSS_anchor, S, S_anchor, lcsStartA, lcsStartB, seedLength, rev
 
+
+def generate_svg(bgc):
+    """Draw the SVG figure for one BGC
+    Color, Pfam and BGC information are taken from the main process' globals
+    """
+    SVG(False, os.path.join(svg_folder,bgc+".svg"), genbankDict[bgc][0], bgc, os.path.join(pfd_folder,bgc+".pfd"), True, color_genes, color_domains, pfam_domain_categories, pfam_info, bgc_info[bgc].records, bgc_info[bgc].max_width)
+
+
 @timeit
 def launch_hmmalign(cores, domain_sequence_list):
     """
     Launches instances of hmmalign with multiprocessing.
     Note that the domains parameter contains the .fasta extension
     """
-    pool = Pool(cores, maxtasksperchild=32)
+    pool = Pool(cores)
     pool.map(run_hmmalign, domain_sequence_list)
     pool.close()
     pool.join()
@@ -1219,7 +1419,7 @@ def launch_hmmalign(cores, domain_sequence_list):
 
 def run_hmmalign(domain_file):
     #domain_file already contains the full path, with the file extension
-    domain_base = domain_file.split(os.sep)[-1][:-6]
+    domain_base = os.path.splitext(os.path.basename(domain_file))[0]
     hmmfetch_pars = ["hmmfetch", os.path.join(pfam_dir,"Pfam-A.hmm.h3m"), domain_base]
     proc_hmmfetch = subprocess.Popen(hmmfetch_pars, stdout=subprocess.PIPE, shell=False)
     
@@ -1283,68 +1483,126 @@ def stockholm_parser(stkFile):
     return
 
 
-def runHmmScan(fastaPath, hmmPath, outputdir, verbose):
-    """ Runs hmmscan command on a fasta file with a single core to generate a
-    domtable file"""
+def runHmmScan(fastaPaths, hmmPath, outputdir, verbose):
+    """ Runs hmmscan with a single core on a batch of fasta files to generate 
+    one domtable file per fasta file.
+    Loading the Pfam database takes longer than scanning a typical BGC, so the
+    files are concatenated and scanned together. The results are then split
+    back by the name of the query sequence"""
     hmmFile = os.path.join(hmmPath,"Pfam-A.hmm")
-    if os.path.isfile(fastaPath):
-        name = ".".join(fastaPath.split(os.sep)[-1].split(".")[:-1])
-        outputName = os.path.join(outputdir, name+".domtable")
-        
-        hmmscan_cmd = "hmmscan --cpu 0 --domtblout {} --cut_tc {} {}".format(outputName, hmmFile, fastaPath)
+    
+    batch_name = os.path.join(outputdir, os.path.splitext(os.path.basename(fastaPaths[0]))[0])
+    batch_fasta = batch_name + ".batch_fasta"
+    batch_domtable = batch_name + ".batch_domtable"
+    
+    # errors are raised (not sys.exit) so that they reach the main process 
+    # instead of killing the worker
+    try:
+        # Key: query name (first word of a fasta header). Item: fasta file name
+        query_owner = {}
+        names = []
+        with open(batch_fasta, "w") as batch_handle:
+            for fastaPath in fastaPaths:
+                if not os.path.isfile(fastaPath):
+                    raise IOError("Fasta file " + fastaPath + " doesn't exist")
+            
+                name = os.path.splitext(os.path.basename(fastaPath))[0]
+                names.append(name)
+                with open(fastaPath, "r") as fasta_handle:
+                    for line in fasta_handle:
+                        if line[0] == ">":
+                            query_owner[line[1:].split(None, 1)[0]] = name
+                        batch_handle.write(line)
+                    
+        # only the domtable is used: send the main (human readable) output, which
+        # is much larger, to the null device instead of capturing it
+        hmmscan_pars = ["hmmscan", "--cpu", "0", "-o", os.devnull, "--domtblout", batch_domtable, "--cut_tc", hmmFile, batch_fasta]
         if verbose == True:
-            print("   " + hmmscan_cmd)
-        subprocess.check_output(hmmscan_cmd, shell=True)
-
-    else:
-        sys.exit("Error running hmmscan: Fasta file " + fastaPath + " doesn't exist")
+            print("   " + " ".join(hmmscan_pars))
+        subprocess.check_call(hmmscan_pars, shell=False)
+    
+        # Split the results. Every domtable file gets the comment lines (column
+        # names at the top, run information at the bottom) even without any hit
+        header = []
+        footer = []
+        hits = defaultdict(list)
+        with open(batch_domtable, "r") as batch_handle:
+            for line in batch_handle:
+                if line[0] == "#":
+                    if len(hits) == 0:
+                        header.append(line)
+                    else:
+                        footer.append(line)
+                else:
+                    hits[query_owner[line.split(None, 4)[3]]].append(line)
+                
+        for name in names:
+            with open(os.path.join(outputdir, name+".domtable"), "w") as domtable_handle:
+                domtable_handle.writelines(header)
+                domtable_handle.writelines(hits[name])
+                domtable_handle.writelines(footer)
+            
+    finally:
+        # don't leave the batch files behind, even if hmmscan failed
+        for batch_file in (batch_fasta, batch_domtable):
+            if os.path.isfile(batch_file):
+                os.remove(batch_file)
 
 
 def parseHmmScan(hmmscanResults, pfd_folder, pfs_folder, overlapCutoff):
-    outputbase = ".".join(hmmscanResults.split(os.sep)[-1].split(".")[:-1])
+    """Reads the domains of a BGC from its domtable file and writes them to 
+    its pfs and pfd files. Returns the BGC name and the number of domains found
+    (None if the domtable file was not found), so the caller can remove BGCs
+    without domains from the analysis"""
+    outputbase = os.path.splitext(os.path.basename(hmmscanResults))[0]
     # try to read the domtable file to find out if this gbk has domains. Domains
     # need to be parsed into fastas anyway.
-    if os.path.isfile(hmmscanResults):
-        pfd_matrix = domtable_parser(outputbase, hmmscanResults)
-        
-        # get number of domains to decide if this BGC should be removed
-        num_domains = len(pfd_matrix)
+    if not os.path.isfile(hmmscanResults):
+        return outputbase, None
+    
+    pfd_matrix = domtable_parser(outputbase, hmmscanResults)
+    
+    # get number of domains to decide if this BGC should be removed
+    num_domains = len(pfd_matrix)
 
-        if num_domains > 0:
-            if verbose:
-                print("  Processing domtable file: " + outputbase)
+    if num_domains > 0:
+        if verbose:
+            print("  Processing domtable file: " + outputbase)
 
-            # check_overlap also sorts the filtered_matrix results and removes
-            # overlapping domains, keeping the highest scoring one
-            filtered_matrix, domains = check_overlap(pfd_matrix,overlapCutoff)
-            
-            # Save list of domains per BGC
-            pfsoutput = os.path.join(pfs_folder, outputbase + ".pfs")
-            with open(pfsoutput, 'w') as pfs_handle:
-                pfs_handle.write(" ".join(domains))
-            
-            # Save more complete information of each domain per BGC
-            pfdoutput = os.path.join(pfd_folder, outputbase + ".pfd")
-            with open(pfdoutput,'w') as pfd_handle:
-                write_pfd(pfd_handle, filtered_matrix)
-        else:
-            # there aren't any domains in this BGC
-            # delete from all data structures
-            print("  No domains where found in {}.domtable. Removing it from further analysis".format(outputbase))
-            info = genbankDict.get(outputbase)
-            clusters.remove(outputbase)
-            baseNames.remove(outputbase)
-            gbk_files.remove(info[0])
-            for sample in info[1]:
-                sampleDict[sample].remove(outputbase)
-            del genbankDict[outputbase]
-            if outputbase in mibig_set:
-                mibig_set.remove(outputbase)
+        # check_overlap also sorts the filtered_matrix results and removes
+        # overlapping domains, keeping the highest scoring one
+        filtered_matrix, domains = check_overlap(pfd_matrix,overlapCutoff)
+        
+        # Save list of domains per BGC
+        pfsoutput = os.path.join(pfs_folder, outputbase + ".pfs")
+        with open(pfsoutput, 'w') as pfs_handle:
+            pfs_handle.write(" ".join(domains))
+        
+        # Save more complete information of each domain per BGC
+        pfdoutput = os.path.join(pfd_folder, outputbase + ".pfd")
+        with open(pfdoutput,'w') as pfd_handle:
+            write_pfd(pfd_handle, filtered_matrix)
             
-    else:
-        sys.exit("Error: hmmscan file " + outputbase + " was not found! (parseHmmScan)")
+    return outputbase, num_domains
+
 
-    return("")
+def parse_hmmscan_file(domtableFile):
+    """Pool version of parseHmmScan, using the folders and overlap cutoff of
+    this run"""
+    return parseHmmScan(domtableFile, pfd_folder, pfs_folder, options.domain_overlap_cutoff)
+
+
+def remove_bgc(outputbase):
+    """Deletes a BGC from all data structures"""
+    info = genbankDict.get(outputbase)
+    clusters.remove(outputbase)
+    baseNames.remove(outputbase)
+    gbk_files.remove(info[0])
+    for sample in info[1]:
+        sampleDict[sample].remove(outputbase)
+    del genbankDict[outputbase]
+    if outputbase in mibig_set:
+        mibig_set.remove(outputbase)
 
 
 def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=[1.0], damping=0.9, clusterClans=False, clanCutoff=(0.5,0.8), htmlFolder=None):
@@ -1468,8 +1726,8 @@ def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=
         
         # add all (allowed) edges
         for bgc1 in bgcs:
-            for bgc2 in simDict.get(bgc1,{}).keys():
-                if simDict[bgc1][bgc2] > 1 - cutoff:
+            for bgc2, similarity in simDict.get(bgc1,{}).items():
+                if similarity > 1 - cutoff:
                     g.add_edge(bgc1, bgc2)
                     
         for subgraph in nx.connected_components(g):
@@ -1504,14 +1762,14 @@ def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=
         for bgc1 in bgcs:
             # first make sure it is similar to itself
             simMatrix[bgcExt2Int[bgc1],bgcExt2Int[bgc1]] = 1
-            for bgc2 in simDict.get(bgc1,{}).keys():
+            for bgc2, similarity in simDict.get(bgc1,{}).items():
                 # you might get 0 values if there were matrix entries under the
                 # cutoff. No need to input these in the sparse matrix
                 
-                if simDict[bgc1][bgc2] > 1-cutoff:
+                if similarity > 1-cutoff:
                     # Ensure symmetry
-                    simMatrix[bgcExt2Int[bgc1], bgcExt2Int[bgc2]] = simDict[bgc1][bgc2]
-                    simMatrix[bgcExt2Int[bgc2], bgcExt2Int[bgc1]] = simDict[bgc1][bgc2]
+                    simMatrix[bgcExt2Int[bgc1], bgcExt2Int[bgc2]] = similarity
+                    simMatrix[bgcExt2Int[bgc2], bgcExt2Int[bgc1]] = similarity
         
         if verbose:
             print("   ...done")
@@ -1617,31 +1875,12 @@ def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=
                     else:
                         specific_domain_list_B = BGCs[clusterNames[bgc]][domain]
                         
-                        num_copies_b = len(specific_domain_list_B)
-                        
-                        DistanceMatrix = np.ndarray((num_copies_a,num_copies_b))
-                        
-                        for domsa in range(num_copies_a):
-                            for domsb in range(num_copies_b):
-                                # TODO NOT taking into consideration any LCS slicing
-                                # i.e. we're comparing ALL copies of this domain
-                                sequence_tag_a = specific_domain_list_A[domsa]
-                                sequence_tag_b = specific_domain_list_B[domsb]
-                                
-                                aligned_seqA = AlignedDomainSequences[sequence_tag_a]
-                                aligned_seqB = AlignedDomainSequences[sequence_tag_b]
-                                
-                                matches = 0
-                                gaps = 0
-                                
-                                for position in range(seq_length):
-                                    if aligned_seqA[position] == aligned_seqB[position]:
-                                        if aligned_seqA[position] != "-":
-                                            matches += 1
-                                        else:
-                                            gaps += 1
-                                            
-                                DistanceMatrix[domsa][domsb] = 1 - ( matches/(seq_length-gaps) )
+                        # TODO NOT taking into consideration any LCS slicing
+                        # i.e. we're comparing ALL copies of this domain.
+                        # All copies come from the same multiple alignment
+                        DistanceMatrix = aligned_distance_matrix(
+                            [AlignedDomainSequences[tag] for tag in specific_domain_list_A],
+                            [AlignedDomainSequences[tag] for tag in specific_domain_list_B])
 
                         BestIndexes = linear_sum_assignment(DistanceMatrix)
                         # at this point is not ensured that we have the same order
@@ -1728,7 +1967,7 @@ def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=
                 famSimMatrix = np.zeros((len(familyIdx), len(familyIdx)), dtype=np.float32)
                 familiesExt2Int = {gcfExtIdx:gcfIntIdx for gcfIntIdx,gcfExtIdx in enumerate(familyIdx)}
                 
-                for familyI, familyJ in [tuple(sorted(combo)) for combo in combinations(familyIdx, 2)]:
+                for familyI, familyJ in combinations(familyIdx, 2):
                     famSimilarities = []
                     # currently uses the average distance of all average distances
                     # between bgc from gcf I to all bgcs from gcf J
@@ -1940,8 +2179,8 @@ def clusterJsonBatch(bgcs, pathBase, className, matrix, pos_alignments, cutoffs=
             clans_file_path = os.path.join(pathBase, "{}_clans_{:4.2f}_{:4.2f}.tsv".format(className,clanClassificationCutoff,clanDistanceCutoff))
             with open(clans_file_path,'w') as clansFile:
                 clansFile.write('#BGC Name\tClan Number\tFamily Number\n')
-                for clan in clansDict.keys():
-                    for family in clansDict[clan]:
+                for clan, families in clansDict.items():
+                    for family in families:
                         for bgc in familiesDict[family]:
                             clansFile.write("{}\t{}\t{}\n".format(clusterNames[bgc], clan, family))
                     
@@ -2395,8 +2634,7 @@ if __name__=="__main__":
         get_gbk_files(bgcs_path, output_folder, bgc_fasta_folder, int(options.min_bgc_size),
                       ['*'], exclude_gbk_str, bgc_info)
         
-        for i in genbankDict.keys():
-            mibig_set.add(i)
+        mibig_set.update(genbankDict)
             
     
     print("\nImporting GenBank files")
@@ -2404,7 +2642,7 @@ if __name__=="__main__":
                   include_gbk_str, exclude_gbk_str, bgc_info)
     
     if has_query_bgc:
-        query_bgc = ".".join(options.query_bgc.split(os.sep)[-1].split(".")[:-1])
+        query_bgc = os.path.splitext(os.path.basename(options.query_bgc))[0]
         if query_bgc in genbankDict:
             print("\nQuery BGC already added")
             pass
@@ -2418,14 +2656,14 @@ if __name__=="__main__":
     # clusters and sampleDict contain the necessary structure for all-vs-all and sample analysis
     clusters = list(genbankDict.keys())
     
-    sampleDict = {} # {sampleName:set(bgc1,bgc2,...)}
+    sampleDict = defaultdict(set) # {sampleName:set(bgc1,bgc2,...)}
     gbk_files = [] # raw list of gbk file locations
     for (cluster, (path, clusterSample)) in genbankDict.items():
         gbk_files.append(path)
         for sample in clusterSample:
-            clustersInSample = sampleDict.get(sample, set())
-            clustersInSample.add(cluster)
-            sampleDict[sample] = clustersInSample
+            sampleDict[sample].add(cluster)
+    # back to a plain dictionary: unknown samples should not be added silently
+    sampleDict = dict(sampleDict)
     
     print("\nCreating output directories")
     svg_folder = os.path.join(output_folder, "SVG")
@@ -2470,20 +2708,18 @@ if __name__=="__main__":
     baseNames = set(clusters)
     
     # All available fasta files (could be more than it should if reusing output folder)
-    allFastaFiles = set(glob(os.path.join(bgc_fasta_folder,"*.fasta")))
+    fastaSizes = file_sizes_by_base(bgc_fasta_folder, ".fasta")
     
     # fastaFiles: all the fasta files that should be there 
     # (i.e. correspond to the input files)
     fastaFiles = set()
     for name in baseNames:
         fastaFiles.add(os.path.join(bgc_fasta_folder, name+".fasta"))
-
-    # fastaBases: the actual fasta files we have that correspond to the input
-    fastaBases = allFastaFiles.intersection(fastaFiles)
     
     # Verify that all input files had their fasta sequences extracted
-    if len(fastaFiles - fastaBases) > 0:
-        sys.exit("Error! The following files did NOT have their fasta sequences extracted: " + ", ".join(fastaFiles - fastaBases))
+    missingFastaFiles = [os.path.join(bgc_fasta_folder, name+".fasta") for name in baseNames if name not in fastaSizes]
+    if len(missingFastaFiles) > 0:
+        sys.exit("Error! The following files did NOT have their fasta sequences extracted: " + ", ".join(missingFastaFiles))
     
     # Make a list of all fasta files that need to be processed
     # (i.e., they don't yet have a corresponding .domtable)
@@ -2494,13 +2730,14 @@ if __name__=="__main__":
     else:
         # find already processed files
         alreadyDone = set()
+        domtableSizes = file_sizes_by_base(domtable_folder, ".domtable")
         for fasta in fastaFiles:
-            outputbase  = ".".join(fasta.split(os.sep)[-1].split(".")[:-1])
+            outputbase  = os.path.splitext(os.path.basename(fasta))[0]
             outputfile = os.path.join(domtable_folder,outputbase + '.domtable')
-            if os.path.isfile(outputfile) and os.path.getsize(outputfile) > 0:
+            if domtableSizes.get(outputbase, 0) > 0:
                 # verify domtable content
                 with open(outputfile, "r") as domtablefile:
-                    for line in domtablefile.readlines():
+                    for line in domtablefile:
                         if line.startswith("# Option settings:"):
                             linecols = line.split()
                             if "hmmscan" in linecols and "--domtblout" in linecols:
@@ -2512,72 +2749,82 @@ if __name__=="__main__":
             print(" All fasta files had already been processed")
         elif len(alreadyDone) > 0:
             if len(task_set) < 20:
-                print(" Warning! The following NEW fasta file(s) will be processed: {}".format(", ".join(".".join(x.split(os.sep)[-1].split(".")[:-1]) for x in task_set)))
+                print(" Warning! The following NEW fasta file(s) will be processed: {}".format(", ".join(os.path.splitext(os.path.basename(x))[0] for x in task_set)))
             else:
                 print(" Warning: {} NEW fasta files will be processed".format(str(len(task_set))))
         else:
             print(" Predicting domains for {} fasta files".format(str(len(fastaFiles))))
         
-    pool = Pool(cores,maxtasksperchild=1)
-    for fastaFile in task_set:
-        pool.apply_async(runHmmScan,args=(fastaFile, pfam_dir, domtable_folder, verbose))
+    # scan the fasta files in batches, a few batches per core
+    task_list = sorted(task_set)
+    batch_size = max(1, min(100, -(-len(task_list) // (cores*4))))
+    pool = Pool(cores)
+    hmmscan_jobs = [pool.apply_async(runHmmScan,args=(task_list[batch_start:batch_start+batch_size], pfam_dir, domtable_folder, verbose)) for batch_start in range(0, len(task_list), batch_size)]
     pool.close()
     pool.join()
+    # a failed batch loses the domtables of all its BGCs: stop here
+    for job in hmmscan_jobs:
+        try:
+            job.get()
+        except Exception as e:
+            sys.exit("Error running hmmscan: {}".format(e))
     print(" Finished generating domtable files.")
 
     ### Step 3: Parse hmmscan domtable results and generate pfs and pfd files
     print("\nParsing hmmscan domtable files")
     
     # All available domtable files
-    allDomtableFiles = set(glob(os.path.join(domtable_folder,"*.domtable")))
+    domtableSizes = file_sizes_by_base(domtable_folder, ".domtable")
     
     # domtableFiles: all domtable files corresponding to the input files
     domtableFiles = set()
     for name in baseNames:
         domtableFiles.add(os.path.join(domtable_folder, name+".domtable"))
     
-    # domtableBases: the actual set of input files with coresponding domtable files
-    domtableBases = allDomtableFiles.intersection(domtableFiles)
-    
     # Verify that all input files have a corresponding domtable file
-    if len(domtableFiles - domtableBases) > 0:
-        sys.exit("Error! The following files did NOT have their domains predicted: " + ", ".join(domtableFiles - domtableBases))
+    missingDomtableFiles = [os.path.join(domtable_folder, name+".domtable") for name in baseNames if name not in domtableSizes]
+    if len(missingDomtableFiles) > 0:
+        sys.exit("Error! The following files did NOT have their domains predicted: " + ", ".join(missingDomtableFiles))
     
     # find already processed files (assuming that if the pfd file exists, the pfs should too)
     alreadyDone = set()
     if not force_hmmscan:
+        pfdSizes = file_sizes_by_base(pfd_folder, ".pfd")
         for domtable in domtableFiles:
-            outputbase = ".".join(domtable.split(os.sep)[-1].split(".")[:-1])
-            outputfile = os.path.join(pfd_folder, outputbase + '.pfd')
-            if os.path.isfile(outputfile) and os.path.getsize(outputfile) > 0:
+            outputbase = os.path.splitext(os.path.basename(domtable))[0]
+            if pfdSizes.get(outputbase, 0) > 0:
                 alreadyDone.add(domtable)
     domtableFilesUnprocessed = domtableFiles - alreadyDone
     if len(domtableFilesUnprocessed) == 0: # Re-run
         print(" All domtable files had already been processed")
     elif len(alreadyDone) > 0: # Incomplete run
         if len(domtableFilesUnprocessed) < 20:
-            print(" Warning! The following domtable files had not been processed: {}".format(", ".join(".".join(x.split(os.sep)[-1].split(".")[:-1]) for x in domtableFilesUnprocessed)))
+            print(" Warning! The following domtable files had not been processed: {}".format(", ".join(os.path.splitext(os.path.basename(x))[0] for x in domtableFilesUnprocessed)))
         else:
             print(" Warning: {} domtable files will be processed".format(str(len(domtableFilesUnprocessed))))
     else: # First run
         print(" Processing {} domtable files".format(str(len(domtableFiles))))
 
-    # If using the multiprocessing version and outputbase doesn't have any
-    #  predicted domains, it's not as easy to remove if from the analysis
-    #  (probably because parseHmmScan only has a copy of clusters et al?)
-    # Using serialized version for now. Probably doesn't have too bad an impact
-    #pool = Pool(cores,maxtasksperchild=32)
-    for domtableFile in domtableFiles - alreadyDone:
-        parseHmmScan(domtableFile, pfd_folder, pfs_folder, options.domain_overlap_cutoff)
-        #pool.apply_async(parseHmmScan, args=(domtableFile,output_folder,options.domain_overlap_cutoff))
-    #pool.close()
-    #pool.join()
+    # The workers only write the pfs/pfd files. BGCs without any predicted
+    # domains are removed from the analysis here, as the workers only have a
+    # copy of clusters et al
+    task_list = sorted(domtableFilesUnprocessed)
+    pool = Pool(cores)
+    for outputbase, num_domains in pool.imap(parse_hmmscan_file, task_list, max(1, min(16, len(task_list)//(cores*4)))):
+        if num_domains is None:
+            sys.exit("Error: hmmscan file " + outputbase + " was not found! (parseHmmScan)")
+        elif num_domains == 0:
+            # there aren't any domains in this BGC
+            print("  No domains where found in {}.domtable. Removing it from further analysis".format(outputbase))
+            remove_bgc(outputbase)
+    pool.close()
+    pool.join()
     
     # If number of pfd files did not change, no new sequences were added to the 
     #  domain fastas and we could try to resume the multiple alignment phase
     # baseNames have been pruned of BGCs with no domains that might've been added temporarily
     try_MA_resume = False
-    if len(baseNames - set(pfd.split(os.sep)[-1][:-9] for pfd in alreadyDone)) == 0:
+    if len(baseNames - set(os.path.splitext(os.path.basename(domtable))[0] for domtable in alreadyDone)) == 0:
         try_MA_resume = True
     else:
         # new sequences will be added to the domain fasta files. Clean domains folder
@@ -2615,9 +2862,8 @@ if __name__=="__main__":
     if options.skip_ma:
         print(" Running with skip_ma parameter: Assuming that the domains folder has all the fasta files")
         try:
-            with open(os.path.join(cache_folder, "BGCs.dict"), "r") as BGC_file:
+            with open(os.path.join(cache_folder, "BGCs.dict"), "rb") as BGC_file:
                 BGCs = pickle.load(BGC_file)
-                BGC_file.close()
         except IOError:
             sys.exit("BGCs file not found...")
     else:
@@ -2628,7 +2874,10 @@ if __name__=="__main__":
                 print("   Processing: " + outputbase)
 
             pfdFile = os.path.join(pfd_folder, outputbase + ".pfd")
-            filtered_matrix = [[part.strip() for part in line.split('\t')] for line in open(pfdFile)]
+            # pfd fields never contain spaces (they come from splitting the
+            # domtable lines), only the line end needs to go
+            with open(pfdFile, "r") as pfd_handle:
+                filtered_matrix = [line.rstrip("\n").split("\t") for line in pfd_handle]
 
             # save each domain sequence from a single BGC in its corresponding file
             fasta_file = os.path.join(bgc_fasta_folder, outputbase + ".fasta")
@@ -2647,9 +2896,14 @@ if __name__=="__main__":
             
         # store processed BGCs dictionary for future re-runs
         with open(os.path.join(cache_folder, "BGCs.dict"), "wb") as BGC_file:
-            pickle.dump(BGCs, BGC_file)
-            BGC_file.close()
+            pickle.dump(BGCs, BGC_file, pickle.HIGHEST_PROTOCOL)
             
+    # anchor domains are listed without version. Keep the full names (as used
+    # in the distance calculation) of those present in our BGCs, so there's no
+    # need to strip the version for every domain of every pair
+    anchor_domain_names = frozenset(domain for bgc_domains in BGCs.values() 
+                                    for domain in bgc_domains if domain.split(".")[0] in anchor_domains)
+    
     # if it's a re-run, the pfd/pfs files were not changed, so the skip_ma flag
     # is activated. We have to open the pfd files to get the gene labels for
     # each domain
@@ -2669,7 +2923,7 @@ if __name__=="__main__":
                 pfd_dict_domains[line.strip().split("\t")[-1]] += 1
         
         # extract the orf number from the tag and use it to traverse the BGC
-        for orf in pfd_dict_domains.keys():
+        for orf in pfd_dict_domains:
             orf_num = int(orf.split(":")[0].split("_ORF")[1])
             orf_keys[orf_num] = orf
         
@@ -2702,9 +2956,9 @@ if __name__=="__main__":
     print(" Reading the ordered list of domains from the pfs files")
     for outputbase in baseNames:
         pfsfile = os.path.join(pfs_folder, outputbase + ".pfs")
-        if os.path.isfile(pfsfile):
+        try:
             DomainList[outputbase] = get_domain_list(pfsfile)
-        else:
+        except IOError:
             sys.exit(" Error: could not open " + outputbase + ".pfs")
                 
                 
@@ -2736,8 +2990,7 @@ if __name__=="__main__":
     # All available SVG files
     availableSVGs = set()
     for svg in glob(os.path.join(svg_folder,"*.svg")):
-        (root, ext) = os.path.splitext(svg)
-        availableSVGs.add(root.split(os.sep)[-1])
+        availableSVGs.add(os.path.splitext(os.path.basename(svg))[0])
         
     # Which files actually need to be generated
     working_set = baseNames - availableSVGs
@@ -2747,12 +3000,16 @@ if __name__=="__main__":
         color_domains = read_color_domains_file()
         pfam_domain_categories = {}
         
-        #This must be done serially, because if a color for a gene/domain
-        # is not found, the text files with colors need to be updated
+        #If a color for a domain is not found, the text file with colors 
+        # needs to be updated. Do that serially first, so that all figures
+        # can be drawn in parallel afterwards
+        add_new_domain_colors([os.path.join(pfd_folder,bgc+".pfd") for bgc in working_set], color_domains)
+        
         print("  Reading BGC information and writing SVG")
-        for bgc in working_set:
-            with open(genbankDict[bgc][0],"r") as handle:
-                SVG(False, os.path.join(svg_folder,bgc+".svg"), handle, bgc, os.path.join(pfd_folder,bgc+".pfd"), True, color_genes, color_domains, pfam_domain_categories, pfam_info, bgc_info[bgc].records, bgc_info[bgc].max_width)
+        pool = Pool(cores, maxtasksperchild=32)
+        pool.map(generate_svg, working_set)
+        pool.close()
+        pool.join()
         
         color_genes.clear()
         color_domains.clear()
@@ -2792,7 +3049,7 @@ if __name__=="__main__":
         header_list = []
         domain_sequence_list_temp = domain_sequence_list.copy()
         for domain_file in domain_sequence_list_temp:
-            domain_name = ".".join(domain_file.split(os.sep)[-1].split(".")[:-1])
+            domain_name = os.path.splitext(os.path.basename(domain_file))[0]
             
             # fill fasta_dict...
             with open(domain_file, "r") as fasta_handle:
@@ -2839,9 +3096,7 @@ if __name__=="__main__":
         sys.exit("No aligned sequences found in the domain folder (run without the --skip_ma parameter or point to the correct output folder)")
     for aligned_file in aligned_files_list:
         with open(aligned_file, "r") as aligned_file_handle:
-            fasta_dict = fasta_parser(aligned_file_handle)
-            for header in fasta_dict:
-                AlignedDomainSequences[header] = fasta_dict[header]
+            AlignedDomainSequences.update(fasta_parser(aligned_file_handle))
 
     clusterNames = tuple(sorted(clusters))
     
@@ -2909,6 +3164,10 @@ if __name__=="__main__":
         for bgc in mibig_set:
             mibig_set_indices.add(name_to_idx[bgc])
 
+    # Workers for the distance calculation. They are started once all the data
+    # they need has been loaded and reused for every network
+    network_pool = Pool(cores, maxtasksperchild=100)
+    
     # Making network files mixing all classes
     if options_mix:
         print("\n Mixing all BGC classes")
@@ -2937,15 +3196,14 @@ if __name__=="__main__":
         create_directory(os.path.join(network_files_folder, "mix"), "  Mix", False)
         
         print("  Calculating all pairwise distances")
+        # pairs are (smaller index, larger index). combinations() over a
+        # sorted list of unique indices gives each pair once, already ordered
         if has_query_bgc:
-            pairs = set([tuple(sorted(combo)) for combo in combinations_product([query_bgc_idx], mix_set)])
+            cluster_pairs = [(min(query_bgc_idx, x), max(query_bgc_idx, x), -1) for x in mix_set]
         else:
-            # convert into a set of ordered tuples
-            pairs = set([tuple(sorted(combo)) for combo in combinations(mix_set, 2)])
+            cluster_pairs = [(x, y, -1) for (x, y) in combinations(sorted(mix_set), 2)]
         
-        cluster_pairs = [(x, y, -1) for (x, y) in pairs]
-        pairs.clear()
-        network_matrix_mix = generate_network(cluster_pairs, cores)
+        network_matrix_mix = generate_network(cluster_pairs, network_pool)
         
         del cluster_pairs[:]
 
@@ -2974,10 +3232,8 @@ if __name__=="__main__":
                 del network_matrix_mix[idx]
             del del_list[:]
             
-            pairs = set([tuple(sorted(combo)) for combo in combinations(new_set, 2)])
-            cluster_pairs = [(x, y, -1) for (x, y) in pairs]
-            pairs.clear()
-            network_matrix_new_set = generate_network(cluster_pairs, cores)
+            cluster_pairs = [(x, y, -1) for (x, y) in combinations(sorted(new_set), 2)]
+            network_matrix_new_set = generate_network(cluster_pairs, network_pool)
             del cluster_pairs[:]
             
             # Update the network matrix (QBGC-vs-all) with the distances of
@@ -3154,14 +3410,13 @@ if __name__=="__main__":
                     network_annotation_file.write("\t".join([bgc, bgc_info[bgc].accession_id, bgc_info[bgc].description, product, sort_bgc(product), bgc_info[bgc].organism, bgc_info[bgc].taxonomy]) + "\n")
             
             print("   Calculating all pairwise distances")
+            bgcClassIdx = bgcClassName2idx[bgc_class]
             if has_query_bgc:
-                pairs = set([tuple(sorted(combo)) for combo in combinations_product([query_bgc_idx],BGC_classes[bgc_class])])
+                cluster_pairs = [(min(query_bgc_idx, x), max(query_bgc_idx, x), bgcClassIdx) for x in BGC_classes[bgc_class]]
             else:
-                pairs = set([tuple(sorted(combo)) for combo in combinations(BGC_classes[bgc_class], 2)])
+                cluster_pairs = [(x, y, bgcClassIdx) for (x, y) in combinations(sorted(BGC_classes[bgc_class]), 2)]
                 
-            cluster_pairs = [(x, y, bgcClassName2idx[bgc_class]) for (x, y) in pairs]
-            pairs.clear()
-            network_matrix = generate_network(cluster_pairs, cores)
+            network_matrix = generate_network(cluster_pairs, network_pool)
             #pickle.dump(network_matrix,open("others.ntwrk",'wb'))
             del cluster_pairs[:]
             #network_matrix = pickle.load(open("others.ntwrk", "rb"))
@@ -3192,10 +3447,8 @@ if __name__=="__main__":
                     del network_matrix[idx]
                 del del_list[:]
                 
-                pairs = set([tuple(sorted(combo)) for combo in combinations(new_set, 2)])
-                cluster_pairs = [(x, y, bgcClassName2idx[bgc_class]) for (x, y) in pairs]
-                pairs.clear()
-                network_matrix_new_set = generate_network(cluster_pairs, cores)
+                cluster_pairs = [(x, y, bgcClassIdx) for (x, y) in combinations(sorted(new_set), 2)]
+                network_matrix_new_set = generate_network(cluster_pairs, network_pool)
                 del cluster_pairs[:]
                                     
                 # Update the network matrix (QBGC-vs-all) with the distances of
@@ -3290,6 +3543,9 @@ if __name__=="__main__":
                     html_subs_per_run[network_html_folder_cutoff].append({ "name" : bgc_class, "css" : bgc_class, "label" : bgc_class})
             del BGC_classes[bgc_class][:]
             del reduced_network[:]
+    
+    network_pool.close()
+    network_pool.join()
 
     # fetch genome list for overview.js
     genomes = []
@@ -3363,7 +3619,8 @@ if __name__=="__main__":
         # update bgc_results.js
         add_to_bigscape_results_js("{}_c{:.2f}".format(run_name, cutoff), html_subs_per_run[html_folder_for_this_cutoff], os.path.join(output_folder, "html_content", "js", "bigscape_results.js"))
 
-    pickle.dump(bgc_info,open(os.path.join(cache_folder,'bgc_info.dict'),'wb'))
+    with open(os.path.join(cache_folder,'bgc_info.dict'),'wb') as bgc_info_file:
+        pickle.dump(bgc_info, bgc_info_file, pickle.HIGHEST_PROTOCOL)
     runtime = time.time()-time1
     runtime_string = "\n\n\tMain function took {:.3f} s".format(runtime)
     with open(os.path.join(log_folder, "runtimes.txt"), 'a') as timings_file:
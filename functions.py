@@ -26,6 +26,7 @@ if version_info[0]==2:
     range = xrange
 
 import os
+import errno
 import subprocess
 import sys
 from encodings import gbk
@@ -40,13 +41,13 @@ verbose = False
 
 
 def create_directory(path, kind, clean):
-    # TODO consider makedirs(path,exists_ok=True)
+    # makedirs(path, exist_ok=True) is not available in Python 2 and would not
+    #  tell us whether the folder was already there
     try:
         os.makedirs(path)
     except OSError as e:
-        # 17 (Linux): "[Errno 17] File exists";
-        # 183 (Windows) "[Error 183] Cannot create a file when that file already exists"
-        if "Errno 17" in str(e) or "Error 183" in str(e):
+        # errno is EEXIST on both Linux (17) and Windows (183 is mapped to it)
+        if e.errno == errno.EEXIST and os.path.isdir(path):
             print(" " + kind + " folder already exists")
             if clean:
                 print("  Cleaning folder")
@@ -57,6 +58,26 @@ def create_directory(path, kind, clean):
             sys.exit(str(e))
 
 
+def file_sizes_by_base(folder, extension):
+    """Lists the files in folder with the given extension in a single pass.
+    Returns a dictionary. Key: file name without the extension. Item: size of
+    the file in bytes"""
+    
+    sizes = {}
+    try:
+        scandir = os.scandir
+    except AttributeError: # Python 2
+        for name in os.listdir(folder):
+            if name.endswith(extension):
+                sizes[name[:-len(extension)]] = os.path.getsize(os.path.join(folder, name))
+        return sizes
+    
+    for entry in scandir(folder):
+        if entry.name.endswith(extension) and entry.is_file():
+            sizes[entry.name[:-len(extension)]] = entry.stat().st_size
+    return sizes
+
+
 def get_anchor_domains(filename):
     """Get the anchor/marker domains from a txt file.
     This text file should contain one Pfam id per line.
@@ -95,24 +116,29 @@ def check_overlap(pfd_matrix, overlap_cutoff):
     """Check if domains overlap for a certain overlap_cutoff.
      If so, remove the domain(s) with the lower score."""
     
+    # only domains from the same CDS can overlap. Group them (in their 
+    # original order) and convert coordinates and scores only once
+    cds_domains = {}
+    for row in pfd_matrix:
+        cds_domains.setdefault(row[-1], []).append((int(row[3]), int(row[4]), float(row[1]), row))
+    
     delete_list = []
-    for i in range(len(pfd_matrix)-1):
-        for j in range(i+1, len(pfd_matrix)):
-            row1 = pfd_matrix[i]
-            row2 = pfd_matrix[j]
-            
-            #check if we are the same CDS
-            if row1[-1] == row2[-1]:
+    for domains in cds_domains.values():
+        for i in range(len(domains)-1):
+            start1, end1, score1, row1 = domains[i]
+            for j in range(i+1, len(domains)):
+                start2, end2, score2, row2 = domains[j]
+                
                 #check if there is overlap between the domains
-                if no_overlap(int(row1[3]), int(row1[4]), int(row2[3]), int(row2[4])) == False:
-                    overlapping_aminoacids = overlap(int(row1[3]), int(row1[4]), int(row2[3]), int(row2[4]))
-                    overlap_perc_loc1 = overlap_perc(overlapping_aminoacids, int(row1[4])-int(row1[3]))
-                    overlap_perc_loc2 = overlap_perc(overlapping_aminoacids, int(row2[4])-int(row2[3]))
+                if no_overlap(start1, end1, start2, end2) == False:
+                    overlapping_aminoacids = overlap(start1, end1, start2, end2)
+                    overlap_perc_loc1 = overlap_perc(overlapping_aminoacids, end1-start1)
+                    overlap_perc_loc2 = overlap_perc(overlapping_aminoacids, end2-start2)
                     #check if the amount of overlap is significant
                     if overlap_perc_loc1 > overlap_cutoff or overlap_perc_loc2 > overlap_cutoff:
-                        if float(row1[1]) >= float(row2[1]): #see which has a better score
+                        if score1 >= score2: #see which has a better score
                             delete_list.append(row2)
-                        elif float(row1[1]) < float(row2[1]):
+                        elif score1 < score2:
                             delete_list.append(row1)
 
     for lst in delete_list:
@@ -227,15 +253,20 @@ def BGC_dic_gen(filtered_matrix):
     
 def save_domain_seqs(filtered_matrix, fasta_dict, domains_folder, outputbase):
     """Write fasta sequences for the domains in the right pfam-domain file"""
+    # group records per domain so each domain file is opened and written once
+    domain_records = {}
     for row in filtered_matrix:
         domain = row[5]
         header = row[-1].strip()
         seq = fasta_dict[header] #access the sequence by using the header
         
-        domain_file = open(os.path.join(domains_folder, domain + ".fasta"), 'a') #append to existing file
-        domain_file.write(">{}:{}:{}\n{}\n".format(header, row[3], row[4],
-            seq[int(row[3])-1:int(row[4])])) #only use the range of the pfam domain within the sequence
-        domain_file.close()
+        #only use the range of the pfam domain within the sequence
+        domain_records.setdefault(domain, []).append(">{}:{}:{}\n{}\n".format(
+            header, row[3], row[4], seq[int(row[3])-1:int(row[4])]))
+        
+    for domain, records in domain_records.items():
+        with open(os.path.join(domains_folder, domain + ".fasta"), 'a') as domain_file: #append to existing file
+            domain_file.write("".join(records))
 
 
 # TODO: marked for deletion
@@ -314,11 +345,12 @@ def write_network_matrix(matrix, cutoffs_and_filenames, include_singletons, clus
     clus1  clus2  rawD  sqrtSim  J  DSS  AI  rDSSna  rDSSa  S   Sa  combGrp  ShrdGrp
     """
     
-    #Open file handles for each cutoff
+    #Open file handles for each cutoff. Network files can get very big and
+    # are written one row at a time, so give them a large buffer
     networkfiles = {}
     cutoffs, filenames = zip(*cutoffs_and_filenames)
     for cutoff, filename in cutoffs_and_filenames:
-        networkfiles[cutoff] = open(filename, "w")
+        networkfiles[cutoff] = open(filename, "w", 1048576)
         networkfiles[cutoff].write("Clustername 1\tClustername 2\tRaw distance\tSquared similarity\tJaccard index\tDSS index\tAdjacency index\traw DSS non-anchor\traw DSS anchor\tNon-anchor domains\tAnchor domains\tCombined group\tShared group\n")
       
     #Dictionaries to keep track of connected nodes, to know which are singletons
@@ -360,6 +392,9 @@ def write_network_matrix(matrix, cutoffs_and_filenames, include_singletons, clus
         else:
             row.append("")
 
+        # the same line goes to every network file whose cutoff the distance
+        # passes. Only build it once, and only if needed
+        line = None
         for cutoff in cutoffs:
             clusterSetAllDict[cutoff].add(gc1)
             clusterSetAllDict[cutoff].add(gc2)
@@ -368,7 +403,9 @@ def write_network_matrix(matrix, cutoffs_and_filenames, include_singletons, clus
                 clusterSetConnectedDict[cutoff].add(gc1)
                 clusterSetConnectedDict[cutoff].add(gc2)
                 
-                networkfiles[cutoff].write("\t".join(map(str,row)) + "\n")
+                if line is None:
+                    line = "\t".join(map(str,row)) + "\n"
+                networkfiles[cutoff].write(line)
 
 
     #Add the nodes without any edges, give them an edge to themselves with a distance of 0
@@ -393,11 +430,12 @@ def fasta_parser(handle):
     for line in handle:
         if line[0] == ">":
             header=line.strip()[1:]
+        # most sequences are on a single line: testing is much cheaper than
+        # raising a KeyError for every record
+        elif header in fasta_dict:
+            fasta_dict[header] += line.strip()
         else:
-            try:
-                fasta_dict[header] += line.strip()
-            except KeyError:
-                fasta_dict[header] = line.strip()
+            fasta_dict[header] = line.strip()
 
     return fasta_dict
 